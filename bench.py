@@ -0,0 +1,257 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# Benchmarks for the mosaic filters.
+# The images used are synthetic, so the numbers can be compared from one run to the other.
+#
+# Every variant of the FUNCS table is timed, and the building blocks on their own:
+# the meshes, the filling of the regions, the gradient maps and the gradient blends.
+# on images of 0.3, 2, 12 and 48 mega pixels.
+#
+# run: python bench.py
+# e.g.
+# python bench.py --sizes 0.3 2 --out before.json
+# python bench.py --sizes 0.3 2 --baseline before.json --threshold .15
+# the second run lists the cases more than 15% slower than in before.json, and exits with 1 if any.
+#
+# Every case is timed with each kernels backend installed (see kernels.py): numpy, then numba.
+# the numba times are listed as '<case>[numba]'.
+# The kernels of the other backends are checked against the numpy ones first: a kernel that
+# gives other results, or records other stages, is listed as a MISMATCH and the run exits with 1.
+
+import io, sys, json, time, random, platform, argparse, contextlib
+import numpy as np
+import cv2
+
+# local imports
+from tiles import squares, delaunay_regions, _halftone_canvas
+import mesh
+from mesh import fib_mesh, lloyd_mesh, random_pts
+from util import fill, ImageContext, region_sums, paint_labels, label_edges, block_means
+from stylise import map_gradient, gradient_blend
+from scheduler import FUNCS
+from instrument import recording, Collector
+import kernels
+
+SIZES = (.3, 2, 12, 48)
+SEED = 0
+
+def synthetic(mp, seed=0):
+	'''
+	Returns a smooth random BGR image of about mp mega pixels, with a 3:2 ratio.
+	the same seed always gives the same image.
+	'''
+	rng = np.random.default_rng(seed)
+	height = int((mp * 1e6 / 1.5) ** .5)
+	width = int(height * 1.5)
+	# low frequency noise, upscaled: looks more like a photo than white noise.
+	small = rng.integers(0, 256, size=(height // 64 + 2, width // 64 + 2, 3), dtype=np.uint8)
+	return np.repeat(np.repeat(small, 64, axis=0), 64, axis=1)[:height, :width].copy()
+
+def timed(f, *args, repeat=3, **kwargs):
+	'''
+	Returns the best wall time of 'repeat' calls to f, in seconds.
+	'''
+	best = float('inf')
+	for _ in range(repeat):
+		start = time.perf_counter()
+		f(*args, **kwargs)
+		best = min(best, time.perf_counter() - start)
+	return best
+
+def seeded(f):
+	'''
+	Returns f, seeding the random generators before each call: the random meshes and
+	the random gradient/blend choices are the same in every run.
+	The fibonacci and lloyd meshes made without a seed take mesh.SEED.
+	'''
+	def call(*args, **kwargs):
+		random.seed(SEED)
+		np.random.seed(SEED)
+		previous, mesh.SEED = mesh.SEED, SEED
+		try:
+			return f(*args, **kwargs)
+		finally:
+			mesh.SEED = previous
+	return call
+
+def cases(img, match=None):
+	'''
+	Yields the (name, function) of every case to time on the image.
+	match: when set, only the cases whose name contains it, what they need is only made for them.
+	'''
+	def wanted(name):
+		return not match or match in name
+
+	for tile_type in FUNCS:
+		for f, kwargs in FUNCS[tile_type]:
+			name = '{}({})'.format(f.__name__, ', '.join('{}={}'.format(k, v) for k, v in sorted(kwargs.items())))
+			if wanted(name):
+				yield name, lambda f=f, kwargs=kwargs: f(img, **kwargs)
+
+	# the variants that share derived planes (gray, equalized, block means): on the image,
+	# then on one ImageContext, as the scheduler runs them.
+	shared = [(f, kwargs) for tile_type in ('squares', 'circles') for f, kwargs in FUNCS[tile_type]]
+	def variants(im):
+		for f, kwargs in shared:
+			f(im, **kwargs)
+	if wanted('squares+circles(image)'):
+		yield 'squares+circles(image)', lambda: variants(img)
+	if wanted('squares+circles(context)'):
+		yield 'squares+circles(context)', lambda: variants(ImageContext(img))
+
+	if wanted('fib_mesh(step=7)'):
+		yield 'fib_mesh(step=7)', lambda: fib_mesh(img, 7, seed=SEED)
+	if wanted('lloyd_mesh(cells=47)'):
+		yield 'lloyd_mesh(cells=47)', lambda: lloyd_mesh(img, 47, seed=SEED)
+	if wanted('random_pts'):
+		yield 'random_pts', lambda: random_pts(img)
+
+	# the filling of the regions only: the mesh is made once
+	if wanted('fill(triangles, fib_step=7)'):
+		vertices = delaunay_regions(fib_mesh(img, 7, seed=SEED))
+		yield 'fill(triangles, fib_step=7)', lambda: fill(img.copy(), [v.copy() for v in vertices])
+
+	if wanted('map_gradient') or wanted('gradient_blend(x4)'):
+		mosaic = squares(img, s=5)
+		if wanted('map_gradient'):
+			yield 'map_gradient', lambda: map_gradient(mosaic)
+		if wanted('gradient_blend(x4)'):
+			gray = cv2.cvtColor(mosaic, cv2.COLOR_BGR2GRAY)
+			# the blend is picked at random: time a few in a row, the same ones in every run.
+			yield 'gradient_blend(x4)', lambda: [gradient_blend(gray) for _ in range(4)]
+
+def check_kernels(img, backends=None):
+	'''
+	Runs the kernels on the image with numpy then with each other backend.
+	Returns the (backend, kernel) that do not give the same results as numpy,
+	or do not record the same stages.
+	'''
+	backends = kernels.available() if backends is None else backends
+	height, width = img.shape[:2]
+	# blocks of random labels, some of them 0 (left untouched)
+	rng = np.random.default_rng(SEED)
+	count = 50
+	small = rng.integers(0, count, size=(height // 16 + 1, width // 16 + 1), dtype=np.int32)
+	labels = np.ascontiguousarray(np.repeat(np.repeat(small, 16, axis=0), 16, axis=1)[:height, :width])
+	outlines = label_edges(labels)
+	gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+	def paint(regions=None, **kwargs):
+		records = Collector()
+		with recording(records):
+			painted = paint_labels(img.copy(), labels, count, outlines=outlines, regions=regions, **kwargs)
+		return painted, regions, [record['stage'] for record in records.records]
+
+	def results():
+		return {
+			'region_sums': region_sums(img, labels, count),
+			'paint': paint(),
+			'paint(contour)': paint(contour=(0, 0, 255)),
+			'paint(regions)': paint(regions={}),
+			'halftone': _halftone_canvas(gray, 7, block_means(gray, 7)),
+		}
+
+	def same(a, b):
+		if isinstance(a, dict):
+			return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+		if isinstance(a, (tuple, list)):
+			return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+		if isinstance(a, np.ndarray):
+			return a.shape == b.shape and np.array_equal(a, b)
+		return a == b
+
+	with kernels.using('numpy'):
+		expected = results()
+	mismatches = []
+	for backend in backends:
+		if backend == 'numpy':
+			continue
+		with kernels.using(backend):
+			kernels.warm()
+			got = results()
+		mismatches += [(backend, name) for name in expected if not same(expected[name], got[name])]
+	return mismatches
+
+def run(sizes=SIZES, repeat=3, match=None, log=print, backends=None):
+	'''
+	Times every case on a synthetic image of each size, with each kernels backend.
+	match: when set, only the cases whose name contains it are timed.
+	backends: the kernels backends to time, all the installed ones by default.
+
+	Returns the results: the machine they were measured on, and the best time of each case
+	in seconds, by '<size>MP/<case>' ('<size>MP/<case>[<backend>]' for the backends other than numpy),
+	and the kernels that do not match the numpy ones (see check_kernels).
+	'''
+	backends = kernels.available() if backends is None else list(backends)
+	results = {
+		'machine': {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv2.__version__,
+					'platform': platform.platform(), 'processor': platform.processor()},
+		'repeat': repeat,
+		'backends': backends,
+		'seconds': {},
+		'mismatches': check_kernels(synthetic(.3, seed=SEED), backends),
+	}
+	for backend, name in results['mismatches']:
+		log('MISMATCH {} kernel {} differs from numpy'.format(backend, name))
+	for backend in backends:
+		with kernels.using(backend):
+			# compile the kernels first: that is not what is timed
+			kernels.warm()
+			for mp in sizes:
+				img = synthetic(mp, seed=SEED)
+				for name, f in cases(img, match):
+					key = '{:g}MP/{}'.format(mp, name) + ('' if backend == 'numpy' else '[{}]'.format(backend))
+					# the meshes print their progress, keep the report readable
+					with contextlib.redirect_stdout(io.StringIO()):
+						results['seconds'][key] = timed(seeded(f), repeat=repeat)
+					log('{:<55} {:10.1f} ms'.format(key, 1000 * results['seconds'][key]))
+	return results
+
+def compare(results, baseline, threshold=.1):
+	'''
+	Returns the cases slower than in the baseline by more than threshold (.1 = 10%):
+	(case, baseline seconds, seconds) tuples, the worst first.
+	'''
+	regressions = []
+	for key, seconds in results['seconds'].items():
+		before = baseline['seconds'].get(key)
+		if before is not None and seconds > before * (1 + threshold):
+			regressions.append((key, before, seconds))
+	return sorted(regressions, key=lambda r: r[2] / r[1], reverse=True)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Times the mosaic filters on synthetic images.')
+	parser.add_argument('--sizes', type=float, nargs='+', default=SIZES, help='the image sizes in mega pixels. default: 0.3 2 12 48')
+	parser.add_argument('--repeat', type=int, default=3, help='the number of runs of each case, the best is kept. default: 3')
+	parser.add_argument('--match', default=None, help='only time the cases whose name contains this. e.g. pentagons')
+	parser.add_argument('--backends', nargs='+', default=None, choices=kernels.BACKENDS,
+						help='the kernels backends to time. default: all the installed ones')
+	parser.add_argument('--out', default=None, help='the json file to save the results to.')
+	parser.add_argument('--baseline', default=None, help='the json file of earlier results to compare to.')
+	parser.add_argument('--threshold', type=float, default=.1, help='the slowdown flagged as a regression. default: .1 (10%%)')
+	args = parser.parse_args(argv)
+
+	results = run(args.sizes, args.repeat, args.match, backends=args.backends)
+	if args.out:
+		with open(args.out, 'w') as f:
+			json.dump(results, f, indent=1)
+	if results['mismatches']:
+		return 1
+
+	if args.baseline:
+		with open(args.baseline) as f:
+			baseline = json.load(f)
+		regressions = compare(results, baseline, args.threshold)
+		for key, before, seconds in regressions:
+			print('REGRESSION {:<55} {:10.1f} ms -> {:10.1f} ms (+{:.0%})'.format(
+				key, 1000 * before, 1000 * seconds, seconds / before - 1))
+		if regressions:
+			return 1
+		print('no regression above {:.0%}'.format(args.threshold))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
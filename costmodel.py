@@ -0,0 +1,127 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# Predicts how long a job takes: one variant of one image (see scheduler.py).
+#
+# The time of a job depends on the size of the image and on the number of regions of its mesh:
+# squares with s=50 on a thumbnail take a millisecond, pentagons with lloyd_cells=2 on a 20 MP image
+# take a long time. Each tile type has a linear model over a few features of the job:
+#   squares, circles: the mega pixels
+#   triangles, pentagons: the mega pixels, the number of mesh cells and the number of lloyd sites
+# The coefficients are fitted with least squares on recorded runs: the 'job' records of a trace
+# (see instrument.py and render.py --trace), or the timings of a Scheduler.
+#
+# The scheduler uses the predictions to start the longest jobs first (LPT).
+# e.g.
+# model = CostModel.load('costs.json')
+# model.predict((4000, 6000, 3), 'pentagons', {'lloyd_cells': 2})
+
+import json
+import numpy as np
+
+# local imports
+from util import map_range
+
+# rough seconds per feature, fitted on the sample images (render.py --costs): good enough to order
+# the jobs before any calibration on the machine that runs them.
+DEFAULT = {
+	'squares': [.005, .08],
+	'circles': [.05, .08],
+	'triangles': [0, .4, 5, 0],
+	'pentagons': [0, .45, 5, 1],
+}
+
+def features(shape, tile, params):
+	'''
+	Returns the features of a job: its cost model is the dot product of them with the coefficients.
+	shape: the shape of the image, tile: the name of the tile function, params: its kwargs.
+	'''
+	height, width = shape[:2]
+	mp = height * width / 1e6
+	if tile in ('squares', 'circles'):
+		return [1, mp]
+	# the number of regions of the mesh, in thousands
+	step, cells = params.get('fib_step'), params.get('lloyd_cells')
+	lloyd = 0
+	if len(params.get('points', [])) != 0:
+		regions = len(params['points'])
+	elif step:
+		# the cells of fib_mesh, each one has a few points
+		s = max((step * width) // 100, 1)
+		regions = -(-height // s) * -(-width // s)
+	elif cells and tile == 'pentagons':
+		# the sites of lloyd_mesh, they are relaxed too
+		regions = lloyd = int(map_range(cells, 1, 100, max(width, height), 1))
+	else:
+		# random_pts
+		regions = max(width, height)
+	return [1, mp, regions / 1e3, lloyd / 1e3]
+
+class CostModel:
+	'''
+	Predicts the wall time of jobs, in seconds. see features
+	'''
+	def __init__(self, coefs=None):
+		self.coefs = {tile: list(c) for tile, c in DEFAULT.items()}
+		self.coefs.update(coefs or {})
+
+	def predict(self, shape, tile, params):
+		coefs = self.coefs.get(tile)
+		if coefs is None:
+			return 0.
+		# a fit can go negative on small jobs: every job takes some time
+		return max(float(np.dot(features(shape, tile, params), coefs)), 1e-4)
+
+	def fit(self, samples):
+		'''
+		Fits the coefficients of each tile type on samples: (shape, tile, params, seconds) tuples.
+		The tile types with fewer samples than features keep their coefficients.
+		Returns self.
+		'''
+		by_tile = {}
+		for shape, tile, params, seconds in samples:
+			x, y = by_tile.setdefault(tile, ([], []))
+			x.append(features(shape, tile, params))
+			y.append(seconds)
+		for tile, (x, y) in by_tile.items():
+			x, y = np.array(x, dtype=float), np.array(y, dtype=float)
+			if len(x) < x.shape[1]:
+				continue
+			self.coefs[tile] = np.linalg.lstsq(x, y, rcond=None)[0].tolist()
+		return self
+
+	def fit_records(self, records):
+		'''
+		Fits the coefficients on the 'job' records of a trace (see instrument.py). Returns self.
+		'''
+		return self.fit([(r['tags']['shape'], r['tags']['tile'], r['tags']['params'], r['wall'])
+						 for r in records if r['stage'] == 'job' and 'shape' in r['tags']])
+
+	def accuracy(self, samples):
+		'''
+		Returns how far the predictions are from the samples: the median and the worst ratio
+		between the predicted and the actual times (1 is perfect, 2 is twice too fast or too slow).
+		'''
+		ratios = [max(p, a) / max(min(p, a), 1e-9) for p, a in
+				  ((self.predict(shape, tile, params), seconds) for shape, tile, params, seconds in samples)]
+		if not ratios:
+			return {'median': None, 'worst': None}
+		return {'median': float(np.median(ratios)), 'worst': float(max(ratios))}
+
+	def save(self, path):
+		with open(path, 'w') as f:
+			json.dump(self.coefs, f, indent=1)
+
+	@classmethod
+	def load(cls, path):
+		with open(path) as f:
+			return cls(json.load(f))
+
+def read_records(path):
+	'''
+	Returns the records of a JSON lines trace file.
+	'''
+	with open(path) as f:
+		return [json.loads(line) for line in f if line.strip()]
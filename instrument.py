@@ -0,0 +1,217 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# Measures the stages of the pipeline: how long each one takes (wall and CPU time), and how
+# much memory it allocates at its peak.
+#
+# The stages are: mesh, triangulation (Delaunay/Voronoi), fill, contour, colormap and blend.
+# Each measure is a record, tagged with what is being made (image, tile type, parameters..)
+# and sent to the sinks that are recording: a JSON lines file, an aggregator in memory, or anything
+# with an emit(record) method.
+# When nothing is recording, a stage costs next to nothing: no clock is read.
+#
+# e.g.
+# totals = Aggregator()
+# with recording(totals), tags(image='img_1.jpg', tile='pentagons'):
+#     pentagons(im, fib_step=7)
+# print(totals.summary())
+#
+# the peak memory is only measured with recording(..., memory=True): tracemalloc slows python down.
+
+import json, time, inspect, functools, threading, tracemalloc, contextvars
+from contextlib import contextmanager
+
+# the sinks currently recording
+_sinks = []
+_sinks_lock = threading.Lock()
+# the tags of the records, e.g. {'image': 'img_1.jpg'}
+_tags = contextvars.ContextVar('tags', default={})
+# the stages being measured in this thread, the innermost last
+_local = threading.local()
+
+def active():
+	'''
+	Returns True when some sink is recording.
+	'''
+	return bool(_sinks)
+
+def add_sink(sink):
+	with _sinks_lock:
+		_sinks.append(sink)
+
+def remove_sink(sink):
+	with _sinks_lock:
+		_sinks.remove(sink)
+
+def emit(record):
+	'''
+	Sends a record to every sink. records made in other processes are sent again with this.
+	'''
+	for sink in list(_sinks):
+		sink.emit(record)
+
+@contextmanager
+def recording(sink, memory=False):
+	'''
+	Sends the records of the stages run in the block to the sink.
+	memory: when True, the peak memory allocated by each stage is measured too, with tracemalloc.
+	'''
+	started = memory and not tracemalloc.is_tracing()
+	if started:
+		tracemalloc.start()
+	add_sink(sink)
+	try:
+		yield sink
+	finally:
+		remove_sink(sink)
+		if started:
+			tracemalloc.stop()
+
+@contextmanager
+def tags(**kwargs):
+	'''
+	Tags the records of the stages run in the block, on top of the current tags.
+	'''
+	token = _tags.set(dict(_tags.get(), **kwargs))
+	try:
+		yield
+	finally:
+		_tags.reset(token)
+
+class stage:
+	'''
+	Measures the block as a stage of the pipeline, e.g.
+
+	with stage('mesh', kind='fibonacci', step=step):
+		...
+
+	The keyword arguments are tags of this record only.
+	'''
+	__slots__ = ('name', 'tags', 'start', 'cpu', 'peak', 'memory')
+
+	def __init__(self, name, **tags):
+		self.name = name
+		self.tags = tags
+
+	def __enter__(self):
+		if not _sinks:
+			self.start = None
+			return self
+		self.memory = tracemalloc.is_tracing()
+		if self.memory:
+			stack = _local.__dict__.setdefault('stack', [])
+			current, peak = tracemalloc.get_traced_memory()
+			# the enclosing stage keeps the peak it reached so far, before it is reset for this one
+			if stack:
+				stack[-1].peak = max(stack[-1].peak, peak - stack[-1].memory)
+			tracemalloc.reset_peak()
+			# memory is the allocated size when the stage starts, from now on
+			self.memory, self.peak = current, 0
+			stack.append(self)
+		self.cpu = time.process_time()
+		self.start = time.perf_counter()
+		return self
+
+	def __exit__(self, *exc):
+		if self.start is None:
+			return False
+		record = {
+			'stage': self.name,
+			'wall': time.perf_counter() - self.start,
+			'cpu': time.process_time() - self.cpu,
+			'peak': None,
+			'tags': dict(_tags.get(), **self.tags),
+			'time': time.time(),
+		}
+		if self.memory is not False and tracemalloc.is_tracing():
+			_local.stack.pop()
+			record['peak'] = max(self.peak, tracemalloc.get_traced_memory()[1] - self.memory)
+		emit(record)
+		return False
+
+def staged(name, arguments=(), **tags):
+	'''
+	Decorates a function: every call is measured as a stage, see stage.
+
+	arguments: the names of the arguments of the function whose values tag the record too, e.g.
+
+	@staged('mesh', ('step',), kind='fibonacci')
+	def fib_mesh(im, step, seed=None):
+		...
+	'''
+	def decorate(f):
+		signature = inspect.signature(f)
+		@functools.wraps(f)
+		def call(*args, **kwargs):
+			if not _sinks:
+				return f(*args, **kwargs)
+			values = {}
+			if arguments:
+				bound = signature.bind(*args, **kwargs)
+				bound.apply_defaults()
+				values = {argument: bound.arguments[argument] for argument in arguments}
+			with stage(name, **dict(tags, **values)):
+				return f(*args, **kwargs)
+		return call
+	return decorate
+
+class JsonLines:
+	'''
+	Appends every record to a file, one JSON object per line.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self._lock = threading.Lock()
+		self._file = open(path, 'a')
+
+	def emit(self, record):
+		line = json.dumps(record, default=str)
+		with self._lock:
+			self._file.write(line + '\n')
+			self._file.flush()
+
+	def close(self):
+		self._file.close()
+
+class Aggregator:
+	'''
+	Keeps the totals of the records, by stage, or by any tag with key.
+	e.g. Aggregator(key=lambda record: (record['stage'], record['tags'].get('tile')))
+	'''
+	def __init__(self, key=lambda record: record['stage']):
+		self.key = key
+		self.totals = {}
+		self._lock = threading.Lock()
+
+	def emit(self, record):
+		with self._lock:
+			total = self.totals.setdefault(self.key(record), {'count': 0, 'wall': 0., 'cpu': 0., 'max_wall': 0., 'peak': None})
+			total['count'] += 1
+			total['wall'] += record['wall']
+			total['cpu'] += record['cpu']
+			total['max_wall'] = max(total['max_wall'], record['wall'])
+			if record['peak'] is not None:
+				total['peak'] = max(total['peak'] or 0, record['peak'])
+
+	def summary(self):
+		'''
+		Returns a table of the totals, the slowest first.
+		'''
+		lines = ['{:<30} {:>7} {:>10} {:>10} {:>10} {:>10}'.format('stage', 'count', 'wall s', 'cpu s', 'max s', 'peak MB')]
+		for key, total in sorted(self.totals.items(), key=lambda item: item[1]['wall'], reverse=True):
+			peak = '' if total['peak'] is None else '{:.1f}'.format(total['peak'] / 2**20)
+			lines.append('{:<30} {:>7} {:>10.3f} {:>10.3f} {:>10.3f} {:>10}'.format(
+				str(key), total['count'], total['wall'], total['cpu'], total['max_wall'], peak))
+		return '\n'.join(lines)
+
+class Collector:
+	'''
+	Keeps the records in a list, e.g. to send them to another process.
+	'''
+	def __init__(self):
+		self.records = []
+
+	def emit(self, record):
+		self.records.append(record)
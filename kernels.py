@@ -0,0 +1,184 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# The pixel loops of the hot paths, compiled with numba when it is installed.
+#
+# The numpy versions go through the image a few times (a bincount per channel, a mask then a gather,
+# a mask per circle..) and hold the GIL in between.
+# The numba versions go through the pixels once, without the GIL, the rows split across threads:
+#   region_sums: the sum of the colors and the area of every region (util.fill)
+#   fill, contour: fill the regions, then draw their borders (util.paint_labels)
+#   halftone: draws the circles of the grid of cells (tiles.circles)
+# They give the same results as the numpy versions: the sums are exact, so are the averages.
+#
+# util.block_means (squares, circles, fib_mesh) has no numba version: its numpy version already sums
+# whole rows at once, and a compiled loop was no faster on the block sizes the tiles use.
+#
+# The backend is chosen at runtime: numba when it can be imported, numpy otherwise.
+# e.g.
+# MOSAICS_KERNELS=numpy python render.py './images/*.jpg'
+# or
+# kernels.use('numpy')
+# with kernels.using('numba'):
+#     squares(im)
+#
+# numba is optional: pip install numba
+# The first call of each kernel compiles it (a few seconds), the compiled code is cached on disk
+# (in __pycache__), so the next processes load it instead. see warm.
+
+import os
+from contextlib import contextmanager
+import numpy as np
+
+try:
+	import numba
+except ImportError:
+	numba = None
+
+BACKENDS = ('numpy', 'numba')
+
+def available():
+	'''
+	Returns the backends that can be used here.
+	'''
+	return [name for name in BACKENDS if name == 'numpy' or numba is not None]
+
+def use(name):
+	'''
+	Selects the backend of the kernels: 'numpy' or 'numba'. Returns the previous one.
+	The processes started after this (see scheduler.py) use it too.
+	'''
+	global _backend
+	if name not in BACKENDS:
+		raise ValueError('unknown kernels backend: {} (expected one of {})'.format(name, ', '.join(BACKENDS)))
+	if name not in available():
+		raise ValueError('the {} kernels backend is not installed'.format(name))
+	previous, _backend = _backend, name
+	return previous
+
+def backend():
+	'''
+	Returns the name of the backend in use.
+	'''
+	return _backend
+
+@contextmanager
+def using(name):
+	'''
+	Uses the backend in the block only.
+	'''
+	previous = use(name)
+	try:
+		yield
+	finally:
+		use(previous)
+
+def threads(n):
+	'''
+	Sets the number of threads the kernels run on, e.g. 1 in the worker processes, like opencv.
+	'''
+	if numba is not None:
+		numba.set_num_threads(max(1, min(n, numba.config.NUMBA_NUM_THREADS)))
+
+_backend = 'numba' if numba is not None else 'numpy'
+if os.environ.get('MOSAICS_KERNELS'):
+	use(os.environ['MOSAICS_KERNELS'])
+
+if numba is not None:
+	_jit = numba.njit(parallel=True, nogil=True, cache=True)
+
+	@_jit
+	def _region_sums(pixels, labels, count, chunks):
+		n, channels = pixels.shape
+		# each thread sums its own chunk of the pixels, then the chunks are added up
+		sums = np.zeros((chunks, count, channels))
+		area = np.zeros((chunks, count), dtype=np.int64)
+		size = (n + chunks - 1) // chunks
+		for k in numba.prange(chunks):
+			for i in range(k * size, min(k * size + size, n)):
+				label = labels[i]
+				area[k, label] += 1
+				for c in range(channels):
+					sums[k, label, c] += pixels[i, c]
+		return sums.sum(axis=0), area.sum(axis=0)
+
+	@_jit
+	def _fill(img, labels, palette):
+		height, width, channels = img.shape
+		for y in numba.prange(height):
+			for x in range(width):
+				label = labels[y, x]
+				if label > 0:
+					for c in range(channels):
+						img[y, x, c] = palette[label, c]
+
+	@_jit
+	def _contour(img, labels, outlines, edge_palette):
+		height, width, channels = img.shape
+		for y in numba.prange(height):
+			for x in range(width):
+				outline = outlines[y, x]
+				if outline > 0 and outline >= labels[y, x]:
+					for c in range(channels):
+						img[y, x, c] = edge_palette[outline, c]
+
+	@_jit
+	def _halftone(radius, fill_color, s, canvas):
+		height, width = canvas.shape
+		for y in numba.prange(height):
+			r, dy = y // s, y % s - s // 2
+			# cell after cell along the row: a pixel is inside the circle when dx**2 <= radius**2 - dy**2
+			for j in range(radius.shape[1]):
+				inside, color = radius[r, j] * radius[r, j] - dy * dy, fill_color[r, j]
+				for x in range(j * s, min(j * s + s, width)):
+					dx = x - j * s - s // 2
+					canvas[y, x] = color if dx * dx <= inside else 255
+
+def region_sums(img, labels, count):
+	'''
+	Same as util.region_sums, in one pass.
+	'''
+	flat = labels.ravel()
+	return _region_sums(img.reshape(flat.size, -1), flat, count, numba.get_num_threads())
+
+def fill(img, labels, palette):
+	'''
+	Fills the pixels of every label > 0 with its palette color, in place. see util.paint_labels
+	'''
+	height, width = labels.shape
+	_fill(img.reshape(height, width, -1), labels, palette.reshape(len(palette), -1))
+	return img
+
+def contour(img, labels, outlines, edge_palette):
+	'''
+	Draws the border pixels (see util.paint_labels) with their edge_palette color, in place.
+	'''
+	height, width = labels.shape
+	_contour(img.reshape(height, width, -1), labels, outlines, edge_palette.reshape(len(edge_palette), -1))
+	return img
+
+def halftone(radius, fill_color, s, height, width):
+	'''
+	Same as the canvas of tiles._halftone_canvas: the circles of the cells, from their radius and fill color.
+	'''
+	canvas = np.empty((height, width), dtype=np.uint8)
+	_halftone(radius, fill_color, s, canvas)
+	return canvas
+
+def warm():
+	'''
+	Compiles the kernels for the images of the mosaics (or loads them from the disk cache),
+	so the first mosaic does not wait for it. Does nothing with the numpy backend.
+	'''
+	if _backend != 'numba':
+		return
+	for shape in ((4, 4, 3), (4, 4)):
+		img = np.zeros(shape, dtype=np.uint8)
+		labels = np.ones((4, 4), dtype=np.int32)
+		region_sums(img, labels, 2)
+		palette = np.zeros((2,) + shape[2:], dtype=np.uint8)
+		fill(img, labels, palette)
+		contour(img, labels, labels, palette)
+	halftone(np.ones((2, 2), dtype=np.intp), np.zeros((2, 2), dtype=np.uint8), 2, 4, 4)
@@ -5,12 +5,54 @@
 
 # This mudule includes the implentation of various mesh types used to create mosaic shapes.
 import cv2
+import os, time, hashlib, threading
+from concurrent.futures import Future
 import numpy as np
-import matplotlib.pyplot as plt
+from scipy.spatial import cKDTree
 
-from util import add_edges, randrange_pts_2d, map_range, normalise
+from instrument import staged
+from util import add_edges, edge_pts, map_range, normalise, SummedArea, ImageContext
 
-def fib_mesh(im, step):
+# the seed of the meshes drawn without one: None draws a new mesh every time.
+# e.g. bench.py sets it, so every run times the same meshes.
+SEED = None
+
+# the number of threads of the kd-tree queries (see lloyd_relax), -1 for one per CPU.
+_workers = -1
+
+def threads(n):
+	'''
+	Sets the number of threads the kd-tree queries run on, e.g. 1 in the worker processes, like opencv.
+	'''
+	global _workers
+	_workers = max(1, n)
+
+def proxy_shape(shape, factor):
+	'''
+	Returns the (height, width) of the image of that shape 'factor' times smaller.
+	'''
+	height, width = shape[:2]
+	return max(height // factor, 1), max(width // factor, 1)
+
+def downscale(im, factor):
+	'''
+	Returns a copy of the image 'factor' times smaller, the proxy a mesh can be computed on.
+	A mesh only needs coarse brightness information, not every pixel.
+	'''
+	height, width = proxy_shape(im.shape, factor)
+	return cv2.resize(im, (width, height), interpolation=cv2.INTER_AREA)
+
+def upscale(points, small, im):
+	'''
+	Scales the points of a mesh computed on the proxy 'small' up to the image 'im' (or its ImageContext).
+	The edges of the proxy are replaced by the edges of the image.
+	'''
+	height, width = im.shape[:2]
+	points = np.asarray(points[:-4], dtype=float) * (width / small.shape[1], height / small.shape[0])
+	return add_edges(points, width, height)
+
+@staged('mesh', ('step',), kind='fibonacci')
+def fib_mesh(im, step, seed=None, table=None, proxy=1):
 	'''
 	Returns an array of points computed with the golden ration.
 
@@ -18,30 +60,40 @@ def fib_mesh(im, step):
 	
 	Arguments:
 
-	im: the image to work with.
+	im: the image to work with, or its ImageContext: the grayscale block means are then shared
+	with the other meshes and tiles of the image.
 	
 	step: used to define the cell size to use. must be > 0 and <= 50.
 	but beware < 10 probably too small for high res.
 	100% means skip 100% percent of the image at a time. not useful, ain't it?!
+
+	seed: the seed of the random generator, the same seed gives the same mesh for the same image.
+
+	table: the SummedArea of the grayscale image. when computing many meshes of the same image,
+	the table answers the brightness of the cells of any step without going through the image again.
+	(with a proxy, the table of the downscaled image)
+
+	proxy: when > 1, the mesh is computed on the image downscaled proxy times, then scaled back up.
+	the cells are the same proportion of the image, so the mesh looks the same, for proxy**2 times less work.
 	'''
 	# check if not backward steps and/or more than 50%
 	assert step > 0 and step <= 50
 
-	# copy the image to prevent inplace operations
-	img = im.copy()
-	height, width = img.shape[:2]
-	
-	# enter the gray area
-	if len(img.shape) > 2:
-		img = cv2.cvtColor(im, cv2.COLOR_BGR2GRAY)
-	
+	context = ImageContext.of(im)
+	if proxy > 1:
+		if table is not None:
+			# the table of the proxy answers the brightness: only its shape is needed, not its pixels.
+			small = np.broadcast_to(np.uint8(0), proxy_shape(im.shape, proxy))
+		else:
+			small = downscale(context.img, proxy)
+		# the mesh of the proxy is part of this stage, not one of its own
+		return upscale(fib_mesh.__wrapped__(small, step, seed, table), small, im)
+
+	height, width = im.shape[:2]
+
 	# convert the step into percentage to prevent uneven ratios based on resolution
-	s = (step * width)// 100
+	s = max((step * width)// 100, 1)
 
-	# init an array of points, dunno why numpy always gives you an element at array init
-	# just override it when I start writting to it damn it!!
-	points = np.zeros((1,2), dtype=int)
-	
 	# using this slightly modified fibonacci sequence. dense areas with opacity ~ 0
 	# will be assigned to larger index number in the fibonacci_ish array
 	# (creating smaller triangles) whist
@@ -51,44 +103,46 @@ def fib_mesh(im, step):
 	# I modified this sequence a bit by removing the first 2 digits to have
 	# a more evenly distributed version for my unevely distributed needs.
 	# 
-	fibonacci_ish = [1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144]
-	# Todo: divide the image in CHUNK sizes and send CHUNKS to each of N treads to compute
-	# these points concurently to speed up things.
-	# CHUNK_SIZE = 100 # any image larger than 100 * 100 will be divided into chuncks of 100 * 100
-	# from threading import Thread
-	# from queue import Queue
-	# from multiprocessing import lock (one thread at a time can append their chunck points)
-	# q = Queue()
-	# def work_a_chunk(w, h, q):
-	# 	pass
-
-	# or be lazy: to keep things simple!
-	for i in range(0, height, s):
-		for j in range(0, width, s):
-			# go s steps at a time and get the average color in each region.
-			y1, y2, x1, x2 = i, i+s, j,  j+s
-			avg = img[y1:y2, x1: x2].mean(axis=0).mean(axis=0)
-			# map this average color to the number of points we need to draw in this region
-			# if the average is too dark, the number will be closer to len(fib-ish) = will
-			# results in many random points being choosen there. as fib numbers go high
-			# depending on the index of the fib number.
-			num_pts = int(map_range(avg, 0,255, len(fibonacci_ish)-1, 0))
-			# now get fib_is[num_points] points from this region.
-			new_points = randrange_pts_2d(x1,x2,y1, y2, fibonacci_ish[num_pts])
-			# append these points to the array.
-			# REMINDER: this could have been the critical region if used concurently.
-			points = np.append(points,new_points, axis=0)
+	fibonacci_ish = np.array([1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144])
+
+	# go s steps at a time and get the average color in each region, all at once.
+	if table is not None:
+		avg = table.block_means(s)
+	else:
+		# enter the gray area
+		avg = context.block_means(s, 'gray')
+	# map this average color to the number of points we need to draw in this region
+	# if the average is too dark, the number will be closer to len(fib-ish) = will
+	# results in many random points being choosen there. as fib numbers go high
+	# depending on the index of the fib number.
+	count = fibonacci_ish[np.intp(map_range(avg, 0, 255, len(fibonacci_ish)-1, 0))].ravel()
+	total = count.sum()
+
+	# the points of all the regions, plus the edges, in one buffer.
+	points = np.empty((total + 4, 2))
+	# draw all the random points at once, in [0, 1[, then stretch them to [0, s]
+	# the same way randrange_pts_2d would have done it for each region.
+	rng = np.random.default_rng(SEED if seed is None else seed)
+	rng.random(out=points[:total])
+	points[:total] *= s + 1
+	np.floor(points[:total], out=points[:total])
+	# move the points of each region to its top left corner
+	rows, cols = avg.shape
+	points[:total, 0] += np.repeat(np.tile(np.arange(cols) * s, rows), count)
+	points[:total, 1] += np.repeat(np.repeat(np.arange(rows) * s, cols), count)
 
 	# add the edges to prevent clipping. and we are done!
-	return add_edges(points, *im.shape[:2])
+	points[total:] = edge_pts(width, height)
+	return points
 
 # allow to make the points denser. 
+@staged('mesh', kind='random')
 def random_pts(im, edges = True):
 	'''
 	Returns an array of random points coordinates withing the image's bounds.
 	Arguments:
 
-	im: the image from which bound the points should conform.
+	im: the image from which bound the points should conform, or its ImageContext.
 	
 	edges: when False, edges are not added to the points set.
 	'''
@@ -108,42 +162,193 @@ def random_pts(im, edges = True):
 
 
 
-def lloyd_mesh(im, cells=10, itter=10):
+def lloyd_relax(width, height, k, itter=10, tol=.5, batch=None, init=None, density=16, seed=None):
+	'''
+	Spreads k sites over a width*height screen with the Lloyd algorithm.
+
+	Every itteration, points sampled all over the screen are labelled with their nearest site,
+	using a kd-tree of the sites, then each site moves to the centroid of its points.
+	more on that here: https://en.wikipedia.org/wiki/Centroidal_Voronoi_tessellation
+
+	Arguments:
+
+	k: the number of sites.
+
+	itter: the maximum number of itterations.
+
+	tol: stop early once no site moved by more than tol pixels in an itteration.
+
+	batch: when set, each itteration only uses 'batch' new random points of the screen and
+	nudges the sites towards their centroid (mini batch k-means). An itteration then costs the same
+	whatever k is.
+
+	init: the sites to start from, e.g. the centers of a previous run (warm start). random when None.
+	missing sites are added at random, extra ones are dropped.
+
+	density: the number of points of the screen per site to use when batch is not set.
+	it is capped to one point per pixel.
+
+	seed: the seed of the random generator.
+
+	Returns the sites and a dict reporting the itterations run, the last shift and the wall time.
+	'''
+	start = time.perf_counter()
+	rng = np.random.default_rng(SEED if seed is None else seed)
+	size = np.array([width, height], dtype=float)
+
+	sites = rng.random((k, 2)) * size
+	if init is not None:
+		init = np.asarray(init, dtype=float)[:k]
+		sites[:len(init)] = init
+
+	if batch is None:
+		# a regular grid of points covering the screen, one per pixel at most
+		n = min(density * k, width * height)
+		step = max((width * height / n) ** .5, 1)
+		xs, ys = np.meshgrid(np.arange(step / 2, width, step), np.arange(step / 2, height, step))
+		points = np.column_stack([xs.ravel(), ys.ravel()])
+	else:
+		# how many points each site has seen so far, used as its learning rate
+		seen = np.zeros(k)
+
+	shift, i = float('inf'), 0
+	while i < itter and shift > tol:
+		if batch is not None:
+			points = rng.random((batch, 2)) * size
+		# label each point with its nearest site
+		_, labels = cKDTree(sites).query(points, workers=_workers)
+		count = np.bincount(labels, minlength=k)
+		centroids = np.column_stack([np.bincount(labels, weights=points[:, c], minlength=k) for c in (0, 1)])
+		moved = count > 0
+		centroids = centroids[moved] / count[moved, None]
+		if batch is None:
+			new = centroids
+		else:
+			seen[moved] += count[moved]
+			rate = (count[moved] / seen[moved])[:, None]
+			new = sites[moved] + rate * (centroids - sites[moved])
+		shift = np.max(np.hypot(*(new - sites[moved]).T), initial=0)
+		sites[moved] = new
+		i += 1
+
+	return sites, {'itterations': i, 'shift': shift, 'time': time.perf_counter() - start}
+
+@staged('mesh', kind='lloyd')
+def lloyd_mesh(im, cells=10, itter=10, tol=.5, batch=None, init=None, seed=None, proxy=1):
 	'''
 	Returns an array of random points coordinates whose shapes are somewhat uniform.
 
-	This algoritm implements Kmean clustering.
+	This algoritm implements the Lloyd relaxation, see lloyd_relax.
 	Arguments:
 
-	im: the image to work with.
+	im: the image to work with, or its ImageContext.
 
 	cells: the % of cell count to have one the screen. 100 means .75% of the image, as 100% will be completly full
 	
-	itter: the number of itteration used to cluster regions.
+	itter: the maximum number of itteration used to relax the regions.
+
+	tol, batch, init, seed: see lloyd_relax. init is usually the previous mesh of this image,
+	with or without its edges.
+
+	proxy: when > 1, the sites are relaxed on a screen proxy times smaller, then scaled back up.
+	the number of cells stays the one of the full image.
 	'''
 	assert cells >= 1 and cells <= 100, 'tiles cannot be larger than 100% of the image'
 	assert itter > 0 and itter < 50, 'invalid iteration number (jic someone puts infinity)'
 
-	# copy the image, to prevent inplace operations
-	img = im.copy()
-
+	height, width = im.shape[:2]
 	# the max of either width or height will decide the ratio
-	cells = int(map_range(cells, 1, 100, max(*im.shape[:2]), 1))
-
-	# get initial random points. Do not include edges as Kmean will disrupt them.
-	points = random_pts(im, edges=False)
-	# create the clusters
-	# Define criteria = ( type, max_iter = 10 by default, epsilon = 1.0 )
-	criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, itter, 1.0)
-	flags = cv2.KMEANS_RANDOM_CENTERS
-	# Apply KMeans
-	_,labels,centers = cv2.kmeans(np.float32(points),cells,None,criteria,itter,flags)
-	# for i in range(cells):
-		# plt.scatter(points[labels.ravel() == i][:,0],points[labels.ravel() == i][:,1])
-	# optionally plot it and see how many points are now only grouped into n regions
-	# plot.show()
-	print('--add done: sent for display---')
-	return add_edges(centers, *im.shape[:2])
+	cells = int(map_range(cells, 1, 100, max(width, height), 1))
+
+	# the screen the sites are relaxed on, and its scale to the image
+	screen = max(width // proxy, 1), max(height // proxy, 1)
+	scale = np.array([width / screen[0], height / screen[1]])
+
+	# do not start from the edges of a previous mesh: they are not sites.
+	if init is not None:
+		init = init[(init[:, 0] >= 0) & (init[:, 0] <= width) & (init[:, 1] >= 0) & (init[:, 1] <= height)]
+		init = init / scale
+	sites, report = lloyd_relax(*screen, cells, itter, tol=tol / proxy, batch=batch, init=init, seed=seed)
+	print('--lloyd mesh: {} cells, {itterations} itterations, last shift {shift:.2f}px, {time:.3f}s--'.format(cells, **report))
+	return add_edges(sites * scale, width, height)
+
+
+class MeshStore:
+	'''
+	Keeps the meshes on disk, so they survive the processes that computed them.
+
+	Each mesh is a .npy file named after a hash of the image content plus the mesh parameters,
+	so the same image always finds its meshes again, whatever its file name. The points are stored
+	as float32 and loaded memory-mapped.
+
+	When the store grows over max_bytes, the least recently used meshes are deleted.
+	'''
+	def __init__(self, path='./.mesh_cache', max_bytes=256 * 2**20):
+		self.path = path
+		self.max_bytes = max_bytes
+		os.makedirs(path, exist_ok=True)
+
+	@staticmethod
+	def image_key(img):
+		'''
+		Returns the hash of the content of the image.
+		'''
+		h = hashlib.blake2b(digest_size=16)
+		h.update('{}{}'.format(img.shape, img.dtype).encode())
+		h.update(np.ascontiguousarray(img).data)
+		return h.hexdigest()
+
+	def key(self, image_key, *params):
+		'''
+		Returns the name of the mesh computed with params on the image whose hash is image_key.
+		'''
+		return hashlib.blake2b(repr((image_key,) + params).encode(), digest_size=16).hexdigest()
+
+	def get(self, key):
+		'''
+		Returns the mesh stored under key, memory-mapped, or None if there is none.
+		'''
+		path = os.path.join(self.path, key + '.npy')
+		try:
+			# mark it as recently used
+			os.utime(path)
+			return np.load(path, mmap_mode='r')
+		except FileNotFoundError:
+			return None
+
+	def put(self, key, points):
+		'''
+		Stores the mesh under key, then makes room if the store is too big.
+		'''
+		path = os.path.join(self.path, key + '.npy')
+		# write to a temporary file first: another process may be reading this key.
+		tmp = '{}.{}.tmp'.format(path, os.getpid())
+		with open(tmp, 'wb') as f:
+			np.save(f, np.float32(points))
+		os.replace(tmp, path)
+		self.evict()
+
+	def evict(self):
+		'''
+		Deletes the least recently used meshes until the store fits in max_bytes.
+		'''
+		files = []
+		for entry in os.scandir(self.path):
+			if entry.name.endswith('.npy'):
+				try:
+					stat = entry.stat()
+				except FileNotFoundError:
+					continue
+				files.append((stat.st_mtime, stat.st_size, entry.path))
+		total = sum(f[1] for f in files)
+		for _, size, path in sorted(files):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+			total -= size
 
 
 # TODO: would it be necessary to replace n random points around even if we cached it already?
@@ -161,44 +366,113 @@ class MeshCache:
 
 	same for lloyd mesh.
 	'''
-	_fib_mesh = {}
-	_lloyd_mesh = {}
-
-	def __init__(self, img):
+	def __init__(self, img, store=None, proxy=1):
 		# only allow one cache per image.
-		self.img = img
+		# the meshes share the derived planes of the image with its tiles, see util.ImageContext
+		self.context = ImageContext.of(img)
+		self.img = self.context.img
+		# compute the meshes on an image proxy times smaller (see fib_mesh)
+		self.proxy = proxy
+		# the on disk store, if any, to share the meshes with other processes and runs
+		self.store = store
+		self._image_key = None
+		# one future per mesh: the first thread asking for a mesh computes it,
+		# the others wait for that same result. the lock only guards the dict, never a computation.
+		self._meshes = {}
+		self._lock = threading.Lock()
+		self.hits = 0 # the mesh was ready
+		self.misses = 0 # the mesh had to be computed
+		self.waits = 0 # the mesh was being computed by another thread
+		self.wait_time = 0. # seconds spent waiting for other threads
+
+	def stats(self):
+		'''
+		Returns the hit, miss and wait counters of the cache.
+		'''
+		with self._lock:
+			return {'hits': self.hits, 'misses': self.misses, 'waits': self.waits, 'wait_time': self.wait_time}
+
+	def _stored(self, compute, *params):
+		'''
+		Returns the mesh with params from the store, or computes it and stores it.
+		'''
+		if self.store is None:
+			return compute()
+		if self._image_key is None:
+			self._image_key = self.store.image_key(self.img)
+		if self.proxy > 1:
+			params += ('proxy', self.proxy)
+		key = self.store.key(self._image_key, *params)
+		points = self.store.get(key)
+		if points is None:
+			points = compute()
+			self.store.put(key, points)
+		return points
 
-	def fib_cache(self, step, lock, memoise=False, max_ = 20):
+	def get(self, key, compute, store=True):
+		'''
+		Returns the mesh cached under key, calling compute() to get it the first time.
+
+		Concurrent calls for the same key wait for a single computation,
+		calls for different keys compute in parallel.
+
+		store: when False, the result is only kept in memory, never in the on disk store.
+		'''
+		with self._lock:
+			future = self._meshes.get(key)
+			owner = future is None
+			if owner:
+				future = self._meshes[key] = Future()
+				self.misses += 1
+			waited = not owner and not future.done()
+			if waited:
+				self.waits += 1
+			elif not owner:
+				self.hits += 1
+
+		if owner:
+			try:
+				future.set_result(self._stored(compute, *key) if store else compute())
+			except BaseException as e:
+				# let the waiting threads know, and let the next call try again.
+				with self._lock:
+					del self._meshes[key]
+				future.set_exception(e)
+			return future.result()
+
+		start = time.perf_counter()
+		points = future.result()
+		if waited:
+			with self._lock:
+				self.wait_time += time.perf_counter() - start
+		return points
+
+	def table(self):
+		'''
+		Returns the summed area table of the grayscale image, computed the first time it is needed.
+		'''
+		if self.proxy == 1:
+			return self.context.table('gray')
+		return self.get(('table',), lambda: SummedArea(downscale(self.context.gray(), self.proxy)), store=False)
+
+	def fib_cache(self, step, memoise=False, max_ = 20):
 		'''
 		Compute the fib mesh of size step, for current image and cashes it
 		because the fib sequence, i can use memoisation here especially for tests. 
 		cache for fib_step 28 should be cache of fib 29 + 30. just add the points together and return them to me
 		'''
-		with lock:
-			if self._fib_mesh.get(step) is not None:
-				print('~~~ reusing fib({}). ~~~'.format(step))
-			elif memoise:
-				if step >= max_:
-					self._fib_mesh[step] = fib_mesh(self.img, max_)
-					return self._fib_mesh[step]
-				elif step == max_ - 1:
-					self._fib_mesh[step] = fib_mesh(self.img, step)
-					return self._fib_mesh[step]
-				else:
-					one = self.fib_cache(step + 1, lock, True)
-					two = self.fib_cache(step + 2, lock, True)
-					self._fib_mesh[step] = np.append(one, two, axis=0)
-					return self._fib_mesh[step]
-			else:
-				# no memoisation: one time transaction!
-				self._fib_mesh[step] = fib_mesh(self.img, step)
-			return self._fib_mesh[step]
-
-	def lloyd_cache(self, cell_itter, lock):
+		if memoise:
+			if step >= max_:
+				return self.fib_cache(max_)
+			elif step < max_ - 1:
+				# the recursion happens outside of any lock: no deadlock.
+				return self.get(('fib-memoised', step, max_), lambda: np.append(
+					self.fib_cache(step + 1, True, max_), self.fib_cache(step + 2, True, max_), axis=0))
+		# no memoisation: one time transaction!
+		return self.get(('fib', step), lambda: fib_mesh(self.context, step, table=self.table(), proxy=self.proxy))
+
+	def lloyd_cache(self, cell_itter):
 		'''
 		Compute the lloyd mesh of (cell,itter) tuple, for current image and cashes it.
 		'''
-		with lock:
-			if self._lloyd_mesh.get(cell_itter) is None:
-				self._lloyd_mesh[cell_itter] = lloyd_mesh(self.img, *cell_itter)
-			return self._lloyd_mesh[cell_itter]
+		return self.get(('lloyd',) + tuple(cell_itter), lambda: lloyd_mesh(self.context, *cell_itter, proxy=self.proxy))
@@ -0,0 +1,215 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# Headless rendering: no window, no key to press. For machines without a display.
+# Every mosaic of every input image is written to disk, with its gradient through every colormap,
+# and a manifest.json describing what each file is.
+#
+# e.g.
+# python render.py './images/*.jpg' --out ./output
+# python render.py './images/*.jpg' --variants squares,pentagons:1,triangles:fib_step=11 --format jpg
+# python render.py './scans/*.png' --variants pentagons --proxy 4
+# python render.py './images/*.jpg' --trace stages.jsonl
+#
+# The encoding of the images (png/jpg) and the writing of the files happen in background threads,
+# while the next mosaics are being rendered.
+
+import os, re, glob, json, time, argparse, ast, inspect
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+
+# local imports
+from scheduler import Scheduler, FUNCS
+from costmodel import CostModel
+import instrument
+
+def parse_variants(spec, funcs=FUNCS):
+	'''
+	Returns the funcs table of the variants in spec, a comma separated list of:
+
+	tile type: all the variants of that type in funcs, e.g. squares
+	tile type:index: one variant of funcs, e.g. pentagons:3
+	tile type:key=value[:key=value...]: a custom variant, e.g. triangles:fib_step=13 or circles:s=1:angle=45
+
+	'all' is every variant in funcs.
+	'''
+	if spec == 'all':
+		return funcs
+	variants = {}
+	for item in spec.split(','):
+		tile_type, *args = item.strip().split(':')
+		if tile_type not in funcs:
+			raise ValueError('unknown tile type: {} (expected one of {})'.format(tile_type, ', '.join(funcs)))
+		if not args:
+			chosen = funcs[tile_type]
+		elif len(args) == 1 and args[0].isdigit():
+			index = int(args[0])
+			if index >= len(funcs[tile_type]):
+				raise ValueError('unknown variant: {} (there are {} {} variants, from 0)'.format(
+					item.strip(), len(funcs[tile_type]), tile_type))
+			chosen = [funcs[tile_type][index]]
+		else:
+			kwargs = {}
+			for arg in args:
+				key, _, value = arg.partition('=')
+				try:
+					kwargs[key] = ast.literal_eval(value)
+				except (ValueError, SyntaxError):
+					kwargs[key] = value
+			f = funcs[tile_type][0][0]
+			try:
+				inspect.signature(f).bind(None, **kwargs)
+			except TypeError as e:
+				raise ValueError('bad variant: {} ({})'.format(item.strip(), e))
+			chosen = [(f, kwargs)]
+		variants.setdefault(tile_type, []).extend(chosen)
+	return variants
+
+def variant_name(f, kwargs):
+	'''
+	Returns a file name friendly name of a variant, e.g. pentagons_fib_step-7
+	Only the letters, digits and ._=- are kept: the arguments cannot make a path.
+	'''
+	name = '_'.join([f.__name__] + ['{}-{}'.format(k, v) for k, v in sorted(kwargs.items())])
+	return re.sub(r'[^A-Za-z0-9_.=-]', '', name)
+
+def stems(paths):
+	'''
+	Returns the file name stem of the outputs of each path, e.g. img_1 for ./images/img_1.jpg.
+	Images with the same name in different folders get a number: img_1, img_1-2, img_1-3..
+	'''
+	names, taken = {}, set()
+	for path in paths:
+		if path in names:
+			continue
+		stem = base = os.path.splitext(os.path.basename(path))[0]
+		n = 1
+		while stem in taken:
+			n += 1
+			stem = '{}-{}'.format(base, n)
+		taken.add(stem)
+		names[path] = stem
+	return names
+
+def write(path, img, params=()):
+	'''
+	Encodes the image in the format of the path's extension and writes it.
+	'''
+	ok, buf = cv2.imencode(os.path.splitext(path)[1], img, list(params))
+	if not ok:
+		raise IOError('cannot encode image: {}'.format(path))
+	with open(path, 'wb') as f:
+		f.write(buf.tobytes())
+	return path
+
+def render(paths, funcs, out, fmt='png', workers=None, encoders=4, proxy=1, memory=False, model=None, backlog=4):
+	'''
+	Renders every variant of every image in paths into the out folder.
+	Returns the manifest: one entry per mosaic, the timings of the jobs and the jobs that failed (see Scheduler).
+
+	backlog: the number of images waiting to be written, per encoder. When the disk is slower than
+	the rendering, the next results wait for the writes: the images waiting stay bounded in memory.
+	'''
+	os.makedirs(out, exist_ok=True)
+	paths = list(paths)
+	names = stems(paths)
+	params = (cv2.IMWRITE_JPEG_QUALITY, 95) if fmt == 'jpg' else ()
+	manifest = []
+	writes = set()
+	def submit(path, img):
+		# wait for room, and raise the first encoding error, if any
+		while len(writes) >= encoders * backlog:
+			done, _ = wait(writes, return_when=FIRST_COMPLETED)
+			for w in done:
+				writes.remove(w)
+				w.result()
+		writes.add(writer.submit(write, path, img, params))
+	with ThreadPoolExecutor(max_workers=encoders) as writer, Scheduler(workers, proxy=proxy, memory=memory, model=model) as scheduler:
+		for (path, f, kwargs), (label, mosaic), gradients in scheduler.run(paths, funcs):
+			stem = '{}_{}'.format(names[path], variant_name(f, kwargs))
+			mosaic_file = os.path.join(out, '{}.{}'.format(stem, fmt))
+			# the encoding happens in the background, the next result can be collected already.
+			submit(mosaic_file, mosaic)
+			entry = {
+				'image': path,
+				'function': f.__name__,
+				'kwargs': kwargs,
+				'mosaic': {'label': label.strip(), 'file': mosaic_file},
+				'gradients': [],
+			}
+			for name, gradient in gradients:
+				gradient_file = os.path.join(out, '{}_gradient_{}.{}'.format(stem, name.lower(), fmt))
+				submit(gradient_file, gradient)
+				entry['gradients'].append({'label': name, 'file': gradient_file})
+			del mosaic, gradients, gradient
+			manifest.append(entry)
+		timings, failed = scheduler.timings, scheduler.failed
+		# raise the first encoding error, if any
+		for w in writes:
+			w.result()
+	return manifest, timings, failed
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Renders mosaics without a display.')
+	parser.add_argument('inputs', nargs='+', help='the images to render, globs are accepted. e.g. "./images/*.jpg"')
+	parser.add_argument('--variants', default='all', help='the variants to render, see parse_variants. default: all')
+	parser.add_argument('--out', default='./output', help='the folder to write to. default: ./output')
+	parser.add_argument('--format', default='png', choices=['png', 'jpg'], help='the output format. default: png')
+	parser.add_argument('--workers', type=int, default=None, help='the number of render processes. default: one per CPU')
+	parser.add_argument('--encoders', type=int, default=4, help='the number of encoding threads. default: 4')
+	parser.add_argument('--proxy', type=int, default=1, help='compute the meshes on images this many times smaller. default: 1')
+	parser.add_argument('--trace', default=None, help='write the time of every stage of every mosaic to this JSON lines file.')
+	parser.add_argument('--memory', action='store_true', help='with --trace, measure the peak memory of the stages too (slower).')
+	parser.add_argument('--costs', default=None, help='the cost model file used to start the longest jobs first, '
+						'calibrated again with the times of this run. default: built in estimates')
+	args = parser.parse_args(argv)
+
+	if args.proxy < 1:
+		parser.error('--proxy must be at least 1')
+	paths = sorted({p for pattern in args.inputs for p in glob.glob(pattern)})
+	if not paths:
+		parser.error('no image matches {}'.format(' '.join(args.inputs)))
+	try:
+		funcs = parse_variants(args.variants)
+	except ValueError as e:
+		parser.error(str(e))
+
+	# the stages of every mosaic, in a file and summed up
+	totals = instrument.Aggregator()
+	sinks = [totals, instrument.JsonLines(args.trace)] if args.trace else []
+	for sink in sinks:
+		instrument.add_sink(sink)
+	start = time.perf_counter()
+	try:
+		model = CostModel.load(args.costs) if args.costs and os.path.exists(args.costs) else CostModel()
+		manifest, timings, failed = render(paths, funcs, args.out, args.format, args.workers, args.encoders,
+								   args.proxy, args.memory, model)
+	finally:
+		for sink in sinks:
+			instrument.remove_sink(sink)
+	elapsed = time.perf_counter() - start
+	if args.trace:
+		sinks[1].close()
+		print(totals.summary())
+
+	with open(os.path.join(args.out, 'manifest.json'), 'w') as f:
+		json.dump(manifest, f, indent=1)
+	for (path, f, kwargs), error in failed:
+		print('FAILED {} {}: {}'.format(path, variant_name(f, kwargs), error))
+
+	# how good the predictions were, then learn from this run for the next one.
+	samples = [(shape, tile, params, seconds) for shape, tile, params, _, seconds in timings]
+	accuracy = model.accuracy(samples)
+	if accuracy['median'] is not None:
+		print('cost model: predictions off by x{median:.2f} (median), x{worst:.2f} (worst)'.format(**accuracy))
+	if args.costs:
+		model.fit(samples).save(args.costs)
+	print('{} images, {} mosaics in {:.1f}s: {:.2f} images/s, {:.2f} mosaics/s{}'.format(
+		len(paths), len(manifest), elapsed, len(paths) / elapsed, len(manifest) / elapsed,
+		', {} failed'.format(len(failed)) if failed else ''))
+
+if __name__ == '__main__':
+	main()
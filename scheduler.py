@@ -0,0 +1,336 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# This module schedules the mosaics of many images on a pool of processes.
+#
+# A job is one variant of one image, e.g. the pentagons with fib_step 7 of img_1.jpg.
+# There is one process per CPU, each takes the next job when it is done with the previous one,
+# so hundreds of images never start more work than the machine can do at once.
+# The results are streamed back as soon as each job is done.
+#
+# The images and the results never go through a pipe: they are shared by handle (see shared.py).
+# each image is decoded once, and every job of that image maps the same memory.
+#
+# Every mosaic is mapped through all the colormaps (see stylise.map_gradients), straight into
+# one shared array: the gradients are never copied.
+#
+# The jobs of the next few images are started longest first, as predicted by a cost model
+# (see costmodel.py): the long jobs do not end up alone at the end while the other workers wait.
+
+import os, time, heapq, itertools, multiprocessing
+from threading import BrokenBarrierError
+from queue import Queue
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import cv2
+
+# local imports
+from tiles import squares, pentagons, triangles, circles
+from mesh import MeshCache, MeshStore
+from util import ImageContext
+from stylise import map_gradients, COLORMAPS, TEXTURES
+from shared import create, share, attach, release, receive
+from costmodel import CostModel
+import instrument
+import kernels
+import mesh
+
+# TEST CASES: the variants made for each image.
+FUNCS = {
+	'squares': [
+		(squares,{}),
+		(squares,{'s':5}),
+		(squares,{'s':30}),
+		(squares,{'s':50}),
+	],
+	'triangles': [
+		(triangles,{}),
+		(triangles,{'fib_step':7}),
+		(triangles,{'fib_step':11}),
+		(triangles,{'fib_step':17}),
+		(triangles,{'fib_step':31}),
+	],
+	'circles': [
+		(circles,{}),
+		(circles,{'s':.5}),
+		(circles,{'s':2}),
+		(circles,{'s':7}),
+	],
+	'pentagons': [
+		(pentagons,{}),
+		(pentagons,{'fib_step':7}), # 5% of the image sampling looks good play with this variable
+		(pentagons,{'fib_step':23}),
+		(pentagons,{'lloyd_cells':2}), # e.g. is 2 = 50%, 5 = 20% dense
+		(pentagons,{'lloyd_cells':47}),
+		(pentagons,{'lloyd_cells':97}),
+	],
+}
+
+LLOYD_ITTER = 10 # find the perfect lloyd tiles after 10 itterations or play with it.
+
+def _init_worker():
+	# one job per CPU already: don't let opencv, the kernels nor the kd-trees start their own threads on top of it.
+	cv2.setNumThreads(1)
+	kernels.threads(1)
+	mesh.threads(1)
+
+def _warm_worker(barrier, timeout):
+	# decode the gradient textures and compile the kernels now, not on the first jobs.
+	for path in TEXTURES.paths():
+		TEXTURES.texture(path)
+	kernels.warm()
+	# hold on to the process until every worker took its own warming task
+	try:
+		barrier.wait(timeout)
+	except BrokenBarrierError:
+		pass
+	return os.getpid()
+
+def read(path):
+	'''
+	Reads the image at path, or raises an IOError.
+	'''
+	im = cv2.imread(path)
+	if im is None:
+		raise IOError('cannot read image: {}'.format(path))
+	return im
+
+@lru_cache(maxsize=2)
+def _load(handle, proxy=1):
+	'''
+	Returns the ImageContext of the shared image of the handle and its mesh cache.
+	The jobs of an image come one after the other, so each worker keeps the last images it attached,
+	with the planes derived from them (see util.ImageContext).
+	The meshes are shared with the other workers through the on disk store.
+	'''
+	context = ImageContext(attach(handle))
+	return context, MeshCache(context, MeshStore(), proxy)
+
+def make_mosaic(im, f, kwargs, mesh_cache=None, out=None):
+	'''
+	Makes one mosaic of the image (or its ImageContext) and its gradient maps, one per colormap.
+	The mesh needed by the variant, if any, comes from the mesh cache.
+	When the tile function can describe its mosaic as regions (see util.paint_labels),
+	the gradients are mapped from them.
+
+	out: a function returning the array to write the gradients to, given its shape:
+	(colormaps, height, width, 3). e.g. shared.create. a new array by default.
+
+	Returns the (label, mosaic) pair and the gradients, a dict of the images by colormap name
+	(views of the array of out).
+	'''
+	kwargs = dict(kwargs)
+	step = kwargs.get('fib_step')
+	cells = kwargs.get('lloyd_cells')
+	if mesh_cache is not None and len(kwargs.get('points', [])) == 0:
+		if step:
+			kwargs['points'] = mesh_cache.fib_cache(step)
+		elif cells:
+			kwargs['points'] = mesh_cache.lloyd_cache((cells, LLOYD_ITTER))
+	# the tile functions label their output when sending it to a queue
+	q = Queue()
+	f(im, queue=q, **kwargs)
+	label, mosaic = q.get()
+	names = list(COLORMAPS)
+	gradients = None if out is None else out((len(names),) + mosaic.shape[:2] + (3,))
+	# the mosaic is at hand: mapping it is one lookup per pixel and colormap, the same as
+	# expanding the mapped palettes of its regions, without building the index image first.
+	return (label, mosaic), map_gradients(mosaic, names, gradients)
+
+def run_job(handle, f, kwargs, proxy=1, trace=None):
+	'''
+	Runs one job in a worker process: one variant of the shared image of the handle.
+	The mosaic and the gradients are sent back shared as well: the label and handle of the mosaic,
+	the colormap names and the handle of the gradients, are returned with the records of the job
+	and the time it took in seconds.
+
+	trace: when not None, the stages of the job are measured (see instrument.py) and their records
+	returned too, tagged with trace['tags']. trace['memory'] measures their peak memory.
+	'''
+	start = time.perf_counter()
+	# the gradients are written straight to shared memory
+	handles = []
+	def out(shape):
+		gradients, array = create(shape)
+		handles.append(gradients)
+		return array
+	try:
+		if trace is None:
+			im, mesh_cache = _load(handle, proxy)
+			(label, mosaic), gradients = make_mosaic(im, f, kwargs, mesh_cache, out)
+			records = []
+		else:
+			collector = instrument.Collector()
+			with instrument.recording(collector, trace['memory']), instrument.tags(**trace['tags']):
+				with instrument.stage('job'):
+					im, mesh_cache = _load(handle, proxy)
+					(label, mosaic), gradients = make_mosaic(im, f, kwargs, mesh_cache, out)
+			records = collector.records
+	except BaseException:
+		for gradients in handles:
+			release(gradients)
+		raise
+	return (label, share(mosaic)), (list(gradients), handles[0]), records, time.perf_counter() - start
+
+class Scheduler:
+	'''
+	Runs jobs on a pool of processes, one per CPU by default.
+
+	Only a few jobs per worker are handed to the pool at a time: the next jobs are only
+	submitted when results are collected, so a slow consumer slows the producer down.
+
+	The jobs of the next 'lookahead' images are known in advance: the one predicted to take the
+	longest by the cost model is submitted first. The predicted and actual time of every job
+	are kept in timings, as (shape, tile, params, predicted, seconds) tuples,
+	and passed to log when set, e.g. to print them as they come.
+
+	An image that cannot be read, or a job that raises, does not stop the others:
+	the failed jobs are kept in failed, as ((path, function, kwargs), error) tuples.
+
+	e.g.
+	with Scheduler() as scheduler:
+		for (path, f, kwargs), (label, mosaic), gradients in scheduler.run(paths):
+			for name, gradient in gradients:
+				...
+	'''
+	def __init__(self, workers=None, backlog=2, proxy=1, memory=False, model=None, lookahead=2, log=None):
+		if proxy < 1:
+			raise ValueError('proxy must be at least 1, got {}'.format(proxy))
+		self.workers = workers or os.cpu_count() or 1
+		# the number of jobs submitted to the pool, per worker
+		self.backlog = backlog
+		# the meshes are computed on images proxy times smaller (see mesh.fib_mesh)
+		self.proxy = proxy
+		# measure the peak memory of the stages, when recording them (see instrument.py)
+		self.memory = memory
+		self.model = model or CostModel()
+		self.lookahead = max(lookahead, 1)
+		self.log = log
+		self.timings = []
+		self.failed = []
+		self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.shutdown()
+
+	def shutdown(self):
+		self.pool.shutdown(cancel_futures=True)
+
+	def warm(self, timeout=60):
+		'''
+		Starts the worker processes and loads what they keep between jobs, before the first job.
+		The warming tasks wait for each other, so each process takes one of them.
+		Returns the number of processes that answered: fewer when some did not start within timeout seconds.
+		'''
+		with multiprocessing.Manager() as manager:
+			barrier = manager.Barrier(self.workers)
+			futures = [self.pool.submit(_warm_worker, barrier, timeout) for _ in range(self.workers)]
+			return len({future.result() for future in futures})
+
+	def run(self, paths, funcs=FUNCS, failed=None, timings=None):
+		'''
+		Runs every variant in funcs on every image in paths.
+		Yields ((path, function, kwargs), (label, mosaic), gradients) for each job, as soon as it is done.
+		gradients is a (colormap name, gradient) list, one per colormap.
+
+		The jobs that failed are not yielded: they are appended to failed, self.failed by default.
+		The timings of the jobs done are appended to timings, self.timings by default.
+		e.g. lists of their own for each run, when runs are made from many threads, or for as long as
+		the scheduler lives (see service.py).
+		'''
+		failed = self.failed if failed is None else failed
+		timings = self.timings if timings is None else timings
+		variants = [(f, kwargs) for tile_type in funcs for f, kwargs in funcs[tile_type]]
+		paths = iter(paths)
+		# the handle, shape and number of jobs not done yet of each image being worked on,
+		# by the order it came in: the same path can come twice.
+		images = {}
+		# the jobs not submitted yet, the longest first: (-predicted, order, image, job)
+		ready = []
+		order = itertools.count()
+		inflight = {}
+		try:
+			while True:
+				# know the jobs of the next few images
+				while len({image for _, _, image, _ in ready}) < self.lookahead:
+					path = next(paths, None)
+					if path is None:
+						break
+					key = next(order)
+					# decode the image once, all its jobs will share it.
+					try:
+						im = read(path)
+						images[key] = [share(im), im.shape, len(variants)]
+					except Exception as e:
+						# every variant of this image fails, the next images go on.
+						failed.extend(((path, f, kwargs), e) for f, kwargs in variants)
+						continue
+					for f, kwargs in variants:
+						try:
+							predicted = self.model.predict(im.shape, f.__name__, kwargs)
+						except (TypeError, ValueError):
+							# parameters the model cannot read: the job will tell what is wrong with them
+							predicted = 0.
+						heapq.heappush(ready, (-predicted, next(order), key, (path, f, kwargs)))
+					del im
+				# keep the pool busy, but not flooded
+				while ready and len(inflight) < self.workers * self.backlog:
+					predicted, _, key, job = heapq.heappop(ready)
+					path, f, kwargs = job
+					# the workers measure their stages when something is recording here
+					trace = None
+					if instrument.active():
+						trace = {'memory': self.memory, 'tags': {'image': path, 'shape': images[key][1],
+																 'tile': f.__name__, 'params': kwargs}}
+					future = self.pool.submit(run_job, images[key][0], f, kwargs, self.proxy, trace)
+					inflight[future] = key, job, -predicted
+				if not inflight:
+					return
+				done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+				for future in done:
+					key, job, predicted = inflight.pop(future)
+					path, f, kwargs = job
+					image = images[key]
+					image[2] -= 1
+					if image[2] == 0:
+						# no more jobs for this image
+						release(image[0])
+						del images[key]
+					try:
+						(label, mosaic_handle), (names, gradient_handle), records, seconds = future.result()
+					except Exception as e:
+						failed.append((job, e))
+						continue
+					for record in records:
+						instrument.emit(record)
+					timing = (image[1], f.__name__, kwargs, predicted, seconds)
+					timings.append(timing)
+					if self.log:
+						self.log(job, predicted, seconds)
+					try:
+						mosaic, gradient = receive(mosaic_handle), receive(gradient_handle)
+					finally:
+						# nothing left behind when receiving fails half way
+						release(mosaic_handle)
+						release(gradient_handle)
+					yield job, (label, mosaic), list(zip(names, gradient))
+		finally:
+			# the run stopped early (the consumer is gone, or something raised):
+			# the jobs not started are cancelled, the results of the others are released as they come.
+			for future in inflight:
+				future.cancel()
+			wait(inflight)
+			for future in inflight:
+				if future.cancelled() or future.exception() is not None:
+					continue
+				(_, mosaic), (_, gradient), _, _ = future.result()
+				release(mosaic)
+				release(gradient)
+			for handle, _, _ in images.values():
+				release(handle)
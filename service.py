@@ -0,0 +1,240 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# A render daemon: the modules are imported once, the worker processes are started once,
+# and everything they keep between jobs stays alive between requests:
+# the gradient textures of each worker (see stylise.TextureCache) and the meshes of the images
+# already seen (see mesh.MeshStore). A request only pays for its rendering.
+#
+# It listens on a local HTTP port, or on a Unix socket.
+# python service.py --port 8765
+# python service.py --socket /tmp/mosaics.sock
+#
+# POST /render renders the variants of one image (see render.parse_variants), given either
+# as a JSON body (Content-Type: application/json):
+# {"path": "./images/img_1.jpg", "variants": "pentagons:1", "out": "./output", "format": "png"}
+# or as the bytes of the image, with the same fields in the query string:
+# curl --data-binary @img_1.jpg 'localhost:8765/render?variants=squares,circles:2'
+# curl --unix-socket /tmp/mosaics.sock -H 'Content-Type: application/json' -d '{"path": "./images/img_1.jpg"}' localhost/render
+#
+# The answer lists every mosaic and its gradients, one per colormap: written to out when it is given,
+# else returned in the answer, encoded in base64.
+# path must be inside the input folder (--inputs, default ./images) and out inside the output folder
+# (--outputs, default ./output): the clients cannot read nor write anywhere else.
+# A bad request is answered 400, a failure of the service (e.g. a file that cannot be written) 500.
+# GET /stats tells how many requests were served and how long they took. GET /health answers ok.
+
+import os, json, time, uuid, base64, socket, socketserver, argparse, threading, traceback
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import cv2
+
+# local imports
+from scheduler import Scheduler
+from render import parse_variants, variant_name, write
+from shared import SHARED_DIR, release
+
+class RenderService:
+	'''
+	Renders the requests on a warm pool of worker processes.
+	The images are read from the inputs folder and written to the outputs folder only.
+	'''
+	def __init__(self, workers=None, proxy=1, inputs='./images', outputs='./output'):
+		self.inputs = os.path.realpath(inputs)
+		self.outputs = os.path.realpath(outputs)
+		self.scheduler = Scheduler(workers, proxy=proxy)
+		self.scheduler.warm()
+		self.requests = 0
+		self.mosaics = 0
+		self.seconds = 0.
+		self._lock = threading.Lock()
+
+	def close(self):
+		self.scheduler.shutdown()
+
+	def render(self, path, variants='all', out=None, fmt='png'):
+		'''
+		Renders the variants of the image at path, inside the inputs folder. Returns the answer of the request.
+		'''
+		_inside(path, self.inputs)
+		return self._render(path, variants, out, fmt)
+
+	def _render(self, path, variants, out, fmt):
+		if out:
+			_inside(out, self.outputs)
+		if fmt not in ('png', 'jpg'):
+			raise ValueError('unknown format: {} (expected png or jpg)'.format(fmt))
+		if not cv2.haveImageReader(path):
+			raise ValueError('cannot read image: {}'.format(path))
+		funcs = parse_variants(variants)
+		params = (cv2.IMWRITE_JPEG_QUALITY, 95) if fmt == 'jpg' else ()
+		if out:
+			os.makedirs(out, exist_ok=True)
+		start = time.perf_counter()
+		mosaics = []
+		# the scheduler lives as long as the service: the failures and timings are kept per request
+		errors, timings = [], []
+		for (_, f, kwargs), (label, mosaic), gradients in self.scheduler.run([path], funcs, errors, timings):
+			stem = '{}_{}'.format(os.path.splitext(os.path.basename(path))[0], variant_name(f, kwargs))
+			entry = {'function': f.__name__, 'kwargs': kwargs,
+					 'mosaic': self._image(label.strip(), mosaic, out, stem, fmt, params), 'gradients': []}
+			for name, gradient in gradients:
+				entry['gradients'].append(self._image(name, gradient, out, '{}_gradient_{}'.format(stem, name.lower()),
+													  fmt, params))
+			mosaics.append(entry)
+		seconds = time.perf_counter() - start
+		if errors and not mosaics:
+			raise RuntimeError('no mosaic was made: {}'.format(errors[0][1]))
+		with self._lock:
+			self.requests += 1
+			self.mosaics += len(mosaics)
+			self.seconds += seconds
+		return {'image': path, 'seconds': seconds, 'mosaics': mosaics,
+				'failed': [{'function': f.__name__, 'kwargs': kwargs, 'error': str(error)}
+						   for (_, f, kwargs), error in errors]}
+
+	def _image(self, label, img, out, name, fmt, params):
+		'''
+		Returns the answer of one image: written to the out folder when it is set, else in base64.
+		'''
+		if out:
+			path = os.path.join(out, '{}.{}'.format(name, fmt))
+			_inside(path, self.outputs)
+			return {'label': label, 'file': write(path, img, params)}
+		ok, buf = cv2.imencode('.' + fmt, img, list(params))
+		return {'label': label, 'data': base64.b64encode(buf.tobytes()).decode('ascii')}
+
+	def render_bytes(self, data, variants='all', out=None, fmt='png'):
+		'''
+		Renders the variants of an encoded image (the bytes of a png, jpg..).
+		'''
+		# the workers read images from files: write it where the shared images are.
+		path = os.path.join(SHARED_DIR, 'mosaics-upload-{}'.format(uuid.uuid4().hex))
+		with open(path, 'wb') as f:
+			f.write(data)
+		try:
+			answer = self._render(path, variants, out, fmt)
+		finally:
+			release(path)
+		answer['image'] = 'upload'
+		return answer
+
+	def stats(self):
+		with self._lock:
+			return {'requests': self.requests, 'mosaics': self.mosaics, 'seconds': self.seconds,
+					'seconds_per_request': self.seconds / self.requests if self.requests else None,
+					'workers': self.scheduler.workers}
+
+def _inside(path, root):
+	'''
+	Raises a ValueError when path is not inside the root folder, once the links and ../ are followed.
+	'''
+	if os.path.commonpath([os.path.realpath(path), root]) != root:
+		raise ValueError('{} is outside of {}'.format(path, root))
+
+class Handler(BaseHTTPRequestHandler):
+	# set by serve
+	service = None
+
+	def address_string(self):
+		# the clients of a Unix socket have no address
+		return self.client_address[0] if self.client_address else 'local'
+
+	def _answer(self, status, body):
+		data = json.dumps(body).encode()
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def do_GET(self):
+		route = urlparse(self.path).path
+		if route == '/health':
+			self._answer(200, {'ok': True})
+		elif route == '/stats':
+			self._answer(200, self.service.stats())
+		else:
+			self._answer(404, {'error': 'unknown route: {}'.format(route)})
+
+	def do_POST(self):
+		url = urlparse(self.path)
+		if url.path != '/render':
+			return self._answer(404, {'error': 'unknown route: {}'.format(url.path)})
+		body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+		query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+		try:
+			if self.headers.get('Content-Type', '').startswith('application/json'):
+				request = json.loads(body)
+				if not isinstance(request, dict):
+					raise ValueError('the body must be a JSON object')
+				if 'path' not in request:
+					raise ValueError('missing field: path')
+				for key in ('path', 'variants', 'out', 'format'):
+					if request.get(key) is not None and not isinstance(request[key], str):
+						raise ValueError('{} must be a string'.format(key))
+				answer = self.service.render(request['path'], request.get('variants', 'all'), request.get('out'),
+											 request.get('format', 'png'))
+			else:
+				answer = self.service.render_bytes(body, query.get('variants', 'all'), query.get('out'),
+												   query.get('format', 'png'))
+		except ValueError as e:
+			return self._answer(400, {'error': str(e)})
+		except Exception as e:
+			# e.g. an opencv error: the service failed, not the request
+			error = '{}: {}'.format(type(e).__name__, e)
+			self.log_error('render failed: %s', error)
+			traceback.print_exc()
+			return self._answer(500, {'error': error})
+		self._answer(200, answer)
+
+class UnixHTTPServer(ThreadingHTTPServer):
+	address_family = socket.AF_UNIX
+
+	def server_bind(self):
+		# no host name nor port to look up on a Unix socket
+		socketserver.TCPServer.server_bind(self)
+		self.server_name, self.server_port = 'localhost', 0
+
+def serve(service, port=8765, path=None):
+	'''
+	Serves the service until interrupted: on a Unix socket at path when set, else on the local port.
+	'''
+	handler = type('ServiceHandler', (Handler,), {'service': service})
+	if path:
+		if os.path.exists(path):
+			os.remove(path)
+		server = UnixHTTPServer(path, handler)
+	else:
+		server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+	print('--serving on {}--'.format(path or 'http://127.0.0.1:{}'.format(port)))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+		if path and os.path.exists(path):
+			os.remove(path)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Serves mosaics from warm worker processes.')
+	parser.add_argument('--port', type=int, default=8765, help='the local port to listen on. default: 8765')
+	parser.add_argument('--socket', default=None, help='listen on this Unix socket instead of a port.')
+	parser.add_argument('--workers', type=int, default=None, help='the number of render processes. default: one per CPU')
+	parser.add_argument('--proxy', type=int, default=1, help='compute the meshes on images this many times smaller. default: 1')
+	parser.add_argument('--inputs', default='./images', help='the folder the images to render are read from. default: ./images')
+	parser.add_argument('--outputs', default='./output', help='the folder the mosaics can be written to. default: ./output')
+	args = parser.parse_args(argv)
+
+	service = RenderService(args.workers, args.proxy, args.inputs, args.outputs)
+	try:
+		serve(service, args.port, args.socket)
+	finally:
+		service.close()
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,59 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# This module passes images between processes without copying them through pipes.
+#
+# An image is written once into a memory-mapped .npy file in shared memory (/dev/shm when there is one)
+# and the processes only exchange the path to it: its handle.
+# Every process maps the same pages, and sees them as a numpy array without any copy.
+#
+# The file can be released (deleted) as soon as the last process that needs it has attached it:
+# the memory stays mapped until the arrays using it are garbage collected.
+
+import os, uuid, tempfile
+import numpy as np
+
+# where the shared images live. /dev/shm is memory, the temp folder is the fallback (e.g. OSX)
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+def create(shape, dtype=np.uint8):
+	'''
+	Creates a shared image. Returns its handle and the array to write it.
+	'''
+	handle = os.path.join(SHARED_DIR, 'mosaics-{}.npy'.format(uuid.uuid4().hex))
+	array = np.lib.format.open_memmap(handle, mode='w+', dtype=dtype, shape=shape)
+	return handle, np.asarray(array)
+
+def share(img):
+	'''
+	Copies the image into a new shared image. Returns its handle.
+	'''
+	handle, array = create(img.shape, img.dtype)
+	array[...] = img
+	return handle
+
+def attach(handle, writable=False):
+	'''
+	Returns the shared image of the handle as a numpy array, without copying it.
+	'''
+	return np.asarray(np.load(handle, mmap_mode='r+' if writable else 'r'))
+
+def release(handle):
+	'''
+	Deletes the shared image. The arrays already attached to it stay valid.
+	'''
+	try:
+		os.remove(handle)
+	except FileNotFoundError:
+		pass
+
+def receive(handle):
+	'''
+	Attaches the shared image and releases it: the returned array owns it from now on.
+	This is how a process takes the results of another one.
+	'''
+	array = attach(handle, writable=True)
+	release(handle)
+	return array
@@ -0,0 +1,260 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# This module renders mosaics of images too big to fit in memory: panoramas, print resolution scans..
+#
+# The image is read from a memory-mapped .npy file, and processed one tile at a time.
+# The result is written, tile after tile, into a memory-mapped .npy file.
+# The memory used only depends on the size of a tile, not the size of the image.
+#
+# e.g.
+# src = np.load('panorama.npy', mmap_mode='r')
+# render_tiled(src, 'panorama_pentagons.npy', 'pentagons', fib_step=7)
+#
+# * squares and circles
+# The tiles are aligned with the grid of squares/circles, so each square or circle is in one tile only
+# (circles spill a pixel or two into the next cells: the circles tiles are drawn with a margin of whole cells).
+# circles equalise the histogram of the whole image first, and skip the gradient blend
+# (the textures are smaller than such images).
+#
+# * triangles and pentagons
+# Even for a huge image, the mesh is only a few thousand points: the Delaunay/Voronoi geometry
+# is computed once for the whole image, so the regions are the same across the borders of the tiles.
+# each tile then only draws the polygons that reach it.
+# A region can be split across many tiles, so its average color is computed over all of them
+# in a first pass, and the tiles are painted in a second pass.
+# opencv draws the sides of a polygon as lines, clipped to the canvas first: a side cut by the border
+# of a tile does not go through the same pixels as on the whole image, tens of pixels into the tile.
+# So the polygons crossing the border of a tile are drawn whole (on their box, inside the image), then
+# their part in the tile is copied. The few polygons bigger than a tile (e.g. the thin triangles along
+# the borders of the image) are drawn on the tile and a HALO around it, so the cut is away from the tile.
+# The tiles are then the same as the whole image: e.g. no pixel differs for the triangles or pentagons
+# of a fibonacci, random or lloyd mesh on a 1600x1200 image, with 256 pixel tiles. With tiles smaller
+# than the triangles (the 47 cells of lloyd with 100 pixel tiles), about .01% of the pixels differ.
+
+import cv2
+import numpy as np
+
+# local imports
+from tiles import delaunay_regions, voronoi_regions, _paint_squares, _halftone_canvas
+from mesh import fib_mesh, lloyd_mesh, random_pts
+from util import region_sums, paint_labels, block_sums, map_range
+
+def windows(height, width, tile):
+	'''
+	Yields the (y0, y1, x0, x1) bounds of each tile*tile window of the image, row by row.
+	'''
+	for y0 in range(0, height, tile):
+		for x0 in range(0, width, tile):
+			yield y0, min(y0 + tile, height), x0, min(x0 + tile, width)
+
+def _gray(img):
+	return cv2.cvtColor(np.ascontiguousarray(img), cv2.COLOR_BGR2GRAY) if len(img.shape) > 2 else np.asarray(img)
+
+class StripMeans:
+	'''
+	Answers the block means of the grayscale version of an image, reading it strip by strip.
+	It can be used as the table of fib_mesh, like a SummedArea, for images too big to have one.
+	'''
+	def __init__(self, img, strip=1024):
+		self.img = img
+		self.strip = strip
+		self.shape = img.shape[:2]
+
+	def block_means(self, s):
+		height, width = self.shape
+		sums = np.zeros((-(-height // s), -(-width // s)))
+		for y0 in range(0, height, self.strip):
+			gray = _gray(self.img[y0:y0 + self.strip])
+			# the sums of the block columns of each row, added to the block row of each row
+			np.add.at(sums, np.arange(y0, y0 + len(gray)) // s, block_sums(gray.T, s, np.float64).T)
+		area = np.outer(np.diff(np.append(np.arange(0, height, s), height)),
+						np.diff(np.append(np.arange(0, width, s), width)))
+		return sums / area
+
+def equalize_lut(img, strip=1024):
+	'''
+	Returns the lookup table that cv2.equalizeHist would apply to the grayscale version of the image,
+	from the histogram of the whole image, read strip by strip.
+	'''
+	hist = np.zeros(256)
+	for y0 in range(0, img.shape[0], strip):
+		hist += cv2.calcHist([_gray(img[y0:y0 + strip])], [0], None, [256], [0, 256]).ravel()
+	# same as opencv: the darkest intensity maps to 0, the others are spread up to 255
+	first = np.flatnonzero(hist)[0]
+	total = hist.sum()
+	if hist[first] == total:
+		return np.full(256, first, dtype=np.uint8)
+	cdf = np.cumsum(hist) - hist[first]
+	lut = np.clip(np.rint(cdf * 255 / (total - hist[first])), 0, 255)
+	lut[:first] = 0
+	return np.uint8(lut)
+
+def _open_output(out, shape, dtype):
+	if isinstance(out, str):
+		return np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+	return out
+
+# the margin around a window, where the polygons too big to be drawn whole are cut (see _rasterise)
+HALO = 64
+
+def _rasterise(window, polygons, boxes, size, limit, outline=False):
+	'''
+	Same as util.label_map (util.outline_map when outline) of the polygons on a window of the image,
+	as if they were drawn on the whole image.
+
+	window: the (y0, y1, x0, x1) bounds of the window.
+	polygons: in the coordinates of the image, they are labelled 1, 2.. in that order.
+	boxes: their (lo, hi) corners, hi excluded. size: the (width, height) of the image.
+	limit: the polygons crossing the border of the window with a box of up to limit pixels are drawn whole,
+	the bigger ones are cut HALO pixels away from the window.
+	'''
+	y0, y1, x0, x1 = window
+	width, height = size
+	# the canvas: the window and the halo around it, inside the image
+	cx0, cy0, cx1, cy1 = max(x0 - HALO, 0), max(y0 - HALO, 0), min(x1 + HALO, width), min(y1 + HALO, height)
+	canvas = np.zeros((cy1 - cy0, cx1 - cx0), dtype=np.int32)
+	origin = np.array([cx0, cy0], dtype=np.int32)
+	def draw(img, v, i):
+		if outline:
+			cv2.polylines(img, [v], True, i, 1)
+		else:
+			cv2.fillPoly(img, [v], i)
+	# the boxes cut by the borders of the image only, like on the whole image
+	lows, highs = np.maximum(boxes[0], 0), np.minimum(boxes[1], size)
+	inside = (lows >= (cx0, cy0)).all(axis=1) & (highs <= (cx1, cy1)).all(axis=1)
+	small = np.prod(highs - lows, axis=1) <= limit
+	for i, v, direct, (lx, ly), (hx, hy) in zip(range(1, len(polygons) + 1), polygons, (inside | ~small).tolist(),
+												lows.tolist(), highs.tolist()):
+		if direct:
+			draw(canvas, v - origin, i)
+			continue
+		# the part of the polygon in the window, from the polygon drawn whole
+		ax0, ay0, ax1, ay1 = max(lx, x0), max(ly, y0), min(hx, x1), min(hy, y1)
+		if ax0 >= ax1 or ay0 >= ay1:
+			continue
+		mask = np.zeros((hy - ly, hx - lx), dtype=np.uint8)
+		draw(mask, v - np.int32([lx, ly]), 1)
+		canvas[ay0 - cy0:ay1 - cy0, ax0 - cx0:ax1 - cx0][mask[ay0 - ly:ay1 - ly, ax0 - lx:ax1 - lx].view(bool)] = i
+	return np.ascontiguousarray(canvas[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0])
+
+def _polygons(src, out, vertices, tile, contour=None, isblank=False):
+	'''
+	Fills the polygons of the whole image, tile by tile. see util.fill
+	'''
+	height, width = src.shape[:2]
+	vertices = [np.int32(v) for v in vertices if len(v) > 0]
+	count = len(vertices) + 1
+	# the bounding box of each polygon, to find the ones reaching a tile
+	lo = np.array([v.min(axis=0) for v in vertices])
+	hi = np.array([v.max(axis=0) for v in vertices])
+
+	def local(y0, y1, x0, x1):
+		# the polygons reaching the window, in the window's coordinates, still in drawing order
+		# and the label they have in the whole image.
+		sel = np.flatnonzero((lo[:, 0] < x1) & (hi[:, 0] >= x0) & (lo[:, 1] < y1) & (hi[:, 1] >= y0))
+		return [vertices[i] for i in sel], sel + 1, (lo[sel], hi[sel] + 1)
+
+	size = np.array([width, height], dtype=np.int32)
+	# a polygon drawn whole takes no more memory than a tile
+	limit = tile * tile
+
+	average = None
+	if not isblank:
+		# first pass: the sum of the colors of each region, over all the tiles.
+		sums = np.zeros((count, src.shape[2] if len(src.shape) > 2 else 1))
+		area = np.zeros(count)
+		for y0, y1, x0, x1 in windows(height, width, tile):
+			polys, ids, boxes = local(y0, y1, x0, x1)
+			# the labels of the window are the index of the polygons in it, the whole image's are ids
+			labels = _rasterise((y0, y1, x0, x1), polys, boxes, size, limit)
+			tile_sums, tile_area = region_sums(np.asarray(src[y0:y1, x0:x1]), labels, len(ids) + 1)
+			ids = np.append(0, ids)
+			sums[ids] += tile_sums
+			area[ids] += tile_area
+		average = sums / np.maximum(area, 1)[:, None]
+
+	# second pass: paint each tile with the average color of its regions.
+	for y0, y1, x0, x1 in windows(height, width, tile):
+		polys, ids, boxes = local(y0, y1, x0, x1)
+		img = np.array(src[y0:y1, x0:x1])
+		outlines = _rasterise((y0, y1, x0, x1), polys, boxes, size, limit, outline=True)
+		if isblank:
+			paint_labels(img, None, 0, contour=contour, isblank=True, outlines=outlines)
+		else:
+			labels = _rasterise((y0, y1, x0, x1), polys, boxes, size, limit)
+			paint_labels(img, labels, len(ids) + 1, contour=contour, outlines=outlines,
+						 average=average[np.append(0, ids)])
+		out[y0:y1, x0:x1] = img
+	return out
+
+def render_tiled(src, out, tile_type, tile=2048, strip=1024, **kwargs):
+	'''
+	Renders the mosaic of an image, tile by tile.
+
+	Arguments:
+
+	src: the image, usually memory-mapped: np.load(path, mmap_mode='r')
+
+	out: the path of the .npy file to write the result to, or an array to write it in.
+
+	tile_type: 'squares', 'circles', 'triangles' or 'pentagons'
+
+	tile: the size of the tiles in pixels. the tiles of squares and circles are rounded to whole cells.
+
+	strip: the number of rows read at a time when going through the whole image.
+
+	kwargs: the arguments of the tile function, e.g. s, fib_step, lloyd_cells, points, contour, isblank
+	(circles do not support angle)
+
+	Returns the output array.
+	'''
+	height, width = src.shape[:2]
+
+	if tile_type == 'squares':
+		# same size as squares()
+		s = kwargs.get('s', 2)
+		s = s if s > 0 and s < 50 else 2
+		s = max((s * max(width, height))// 100, 1)
+		out = _open_output(out, src.shape, src.dtype)
+		for y0, y1, x0, x1 in windows(height, width, max(tile // s, 1) * s):
+			out[y0:y1, x0:x1] = _paint_squares(np.array(src[y0:y1, x0:x1]), s)
+		return out
+
+	if tile_type == 'circles':
+		assert kwargs.get('angle', 0) % 360 == 0, 'tiled circles cannot be rotated'
+		# same size as circles()
+		s = kwargs.get('s', .6)
+		s = s if s > 0 and s < 50 else 2
+		s = max(int(map_range(s, 0, 50, 0, max(width, height))), 1)
+		lut = equalize_lut(src, strip)
+		out = _open_output(out, (height, width, 3), np.uint8)
+		# the circles go up to 2 pixels past their cell (1 when s >= 4): draw the tile with whole cells
+		# around it so the circles of the next tiles overlap it the same way as on the whole image.
+		m = max(s, -(-2 // s) * s)
+		for y0, y1, x0, x1 in windows(height, width, max(tile // s, 1) * s):
+			top, left = max(y0 - m, 0), max(x0 - m, 0)
+			img = lut[_gray(src[top:min(y1 + m, height), left:min(x1 + m, width)])]
+			window = np.s_[y0 - top:y1 - top, x0 - left:x1 - left]
+			canvas = cv2.addWeighted(_halftone_canvas(img, s)[window], .9, img[window], .1, 2)
+			out[y0:y1, x0:x1] = cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR)
+		return out
+
+	if tile_type not in ('triangles', 'pentagons'):
+		raise ValueError('unknown tile type: {}'.format(tile_type))
+
+	# the mesh of the whole image: only the fibonacci mesh needs to read the pixels, strip by strip.
+	points = kwargs.get('points', [])
+	if len(points) == 0:
+		if kwargs.get('fib_step'):
+			points = fib_mesh(src, kwargs['fib_step'], table=StripMeans(src, strip))
+		elif tile_type == 'pentagons' and kwargs.get('lloyd_cells'):
+			points = lloyd_mesh(src, kwargs['lloyd_cells'])
+		else:
+			points = random_pts(src)
+	vertices = delaunay_regions(points) if tile_type == 'triangles' else voronoi_regions(points)
+
+	out = _open_output(out, src.shape, src.dtype)
+	return _polygons(src, out, vertices, tile, kwargs.get('contour'), kwargs.get('isblank', False))
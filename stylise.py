@@ -18,57 +18,205 @@
 # TODO: even after a UI gets implemented. maybe have a random option where the program will generate a random combination of styling.. instead of having the user trying them all...
 # You never know. unless you tried them all//
 
-import cv2, random, glob
+import cv2, random, glob, os, math, threading
+import numpy as np
+from collections import OrderedDict
+
+# local imports
+from instrument import staged
 
 # The separated text effect
 #  b.append(' '.join(video.xml_captions[0].text).split('\n'))
 
+# more on gradient map: https://docs.opencv.org/2.4/modules/contrib/doc/facerec/colormaps.html
+COLORMAPS = {
+	"AUTUMN": cv2.COLORMAP_AUTUMN,
+	"BONE": cv2.COLORMAP_BONE,
+	"JET": cv2.COLORMAP_JET,
+	"WINTER": cv2.COLORMAP_WINTER,
+	"RAINBOW": cv2.COLORMAP_RAINBOW,
+	"OCEAN": cv2.COLORMAP_OCEAN,
+	"SUMMER": cv2.COLORMAP_SUMMER,
+	"SPRING": cv2.COLORMAP_SPRING,
+	"COOL": cv2.COLORMAP_COOL,
+	"HSV": cv2.COLORMAP_HSV,
+	"PINK": cv2.COLORMAP_PINK,
+	"HOT": cv2.COLORMAP_HOT
+}
+
+# the 256 BGR colors of each colormap, made once: applying a colormap is looking its colors up.
+# (256, 1, 3) is the shape opencv takes as a user colormap.
+LUTS = {name: cv2.applyColorMap(np.arange(256, dtype=np.uint8).reshape(256, 1), cmap)
+		for name, cmap in COLORMAPS.items()}
+
+def colormap_indices(img):
+	'''
+	Returns the index of each pixel in the colormaps: its intensity, like cv2.applyColorMap does.
+	'''
+	return cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if len(img.shape) > 2 else img
+
+@staged('colormap')
+def map_gradients(img, names=None, out=None):
+	'''
+	Maps the image through many gradients at once, all of them by default.
+	The image is converted to colormap indices once, then each gradient is one lookup.
+
+	names: the colormaps to apply, see COLORMAPS.
+
+	out: optional preallocated output, a (len(names), height, width, 3) uint8 array.
+	e.g. reusing the same buffer for every mosaic of the same size.
+
+	Returns a dict of the mapped images by colormap name (views of out, when given).
+	'''
+	names = list(COLORMAPS) if names is None else list(names)
+	indices = colormap_indices(img)
+	if out is None:
+		out = np.empty((len(names),) + indices.shape + (3,), dtype=np.uint8)
+	for name, o in zip(names, out):
+		cv2.applyColorMap(indices, LUTS[name], dst=o)
+	return dict(zip(names, out))
+
+@staged('colormap')
+def map_palettes(palette, names=None):
+	'''
+	Maps the colors of a palette through many gradients at once, all of them by default.
+	e.g. the palette of the regions of a mosaic: n colors instead of every pixel.
+	the mapped mosaic is then mapped_palette[regions['index']]
+
+	Returns a dict of the mapped palettes by colormap name.
+	'''
+	names = list(COLORMAPS) if names is None else list(names)
+	indices = colormap_indices(palette.reshape(1, -1, palette.shape[-1]))
+	return {name: cv2.applyColorMap(indices, LUTS[name])[0] for name in names}
+
+def map_regions(regions, names=None, out=None):
+	'''
+	Maps a mosaic through many gradients from its regions only (see tiles.pentagons),
+	without the mosaic image: e.g. regions kept from an earlier render.
+
+	A gradient only depends on the intensity of a color: the intensities of the palette are spread
+	over the image once, then each gradient is one lookup, like map_gradients.
+	When the mosaic image is at hand, map_gradients of it is faster (no gather).
+
+	out: optional preallocated output, see map_gradients.
+
+	Returns a dict of the mapped images by colormap name, the same as map_gradients of the mosaic.
+	'''
+	palette = regions['palette']
+	intensity = colormap_indices(palette.reshape(1, -1, palette.shape[-1]))[0]
+	return map_gradients(np.take(intensity, regions['index']), names, out)
+
 # applies a random gradien map to an image 
+@staged('colormap')
 def map_gradient(img, queue = None):
 	'''
 	Gradient map maps replaces the colors inside the image by those of the gradient.
 	
 	but test images run through all of them, so all of them have equal change of being chosen.
+	use map_gradients to get all of them at once.
     '''
 	# todo: create costom gradients
-	# more on gradient map: https://docs.opencv.org/2.4/modules/contrib/doc/facerec/colormaps.html
-	gradients = {
-		"AUTUMN": cv2.COLORMAP_AUTUMN,
-		"BONE": cv2.COLORMAP_BONE,
-		"JET": cv2.COLORMAP_JET,
-		"WINTER": cv2.COLORMAP_WINTER,
-		"RAINBOW": cv2.COLORMAP_RAINBOW,
-		"OCEAN": cv2.COLORMAP_OCEAN,
-		"SUMMER": cv2.COLORMAP_SUMMER,
-		"SPRING": cv2.COLORMAP_SPRING,
-		"COOL": cv2.COLORMAP_COOL,
-		"HSV": cv2.COLORMAP_HSV,
-		"PINK": cv2.COLORMAP_PINK,
-		"HOT": cv2.COLORMAP_HOT
-	}
-	the_chosen_one = random.choice(list(gradients.keys()))
+	the_chosen_one = random.choice(list(COLORMAPS.keys()))
 	# currently returning a random gradient, for a
 	# lack of UI to select and or customise one.
-	img = cv2.applyColorMap(img,gradients[the_chosen_one])
+	img = cv2.applyColorMap(colormap_indices(img), LUTS[the_chosen_one])
 	if queue:
 		queue.put((the_chosen_one,img)) # the first argument will be used as label for display
 	else:
 		return img
 
-def gradient_blend(im):
+class TextureCache:
+	'''
+	The gradient textures of a folder, read and decoded once per process.
+
+	The textures are cut to the size of the images they are blended with: each (texture, height, width)
+	version is kept too, the least recently used ones are dropped once they take more than max_bytes.
+	e.g.
+	textures = TextureCache('./gradients')
+	texture = textures.get(textures.paths()[0], 600, 800)
+	'''
+	EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+	def __init__(self, folder='./gradients', max_bytes=128*2**20):
+		self.folder = folder
+		self.max_bytes = max_bytes
+		self._paths = None
+		# the decoded textures, by path
+		self._textures = {}
+		# the versions cut to a size, by (path, height, width), oldest first
+		self._sized = OrderedDict()
+		self._bytes = 0
+		self._lock = threading.Lock()
+
+	def paths(self):
+		'''
+		Returns the paths of the textures in the folder, listed on first use.
+		'''
+		if self._paths is None:
+			self._paths = sorted(f for f in glob.glob(os.path.join(self.folder, '*'))
+								 if os.path.splitext(f)[1].lower() in self.EXTENSIONS)
+		return self._paths
+
+	def texture(self, path):
+		'''
+		Returns the decoded texture of the path, or None if it cannot be read.
+		'''
+		with self._lock:
+			if path not in self._textures:
+				self._textures[path] = cv2.imread(path)
+			return self._textures[path]
+
+	def get(self, path, height, width):
+		'''
+		Returns the texture of the path at the height*width size, or None if it cannot be read.
+
+		A texture large enough is cropped, like it always was. A smaller one is scaled up to cover
+		the size, keeping its proportions, then cropped.
+		'''
+		key = (path, height, width)
+		with self._lock:
+			if key in self._sized:
+				self._sized.move_to_end(key)
+				return self._sized[key]
+		texture = self.texture(path)
+		if texture is None:
+			return None
+		th, tw = texture.shape[:2]
+		if th < height or tw < width:
+			scale = max(height / th, width / tw)
+			size = (max(math.ceil(tw * scale), width), max(math.ceil(th * scale), height))
+			texture = cv2.resize(texture, size, interpolation=cv2.INTER_LINEAR)
+		sized = np.ascontiguousarray(texture[:height, :width])
+		with self._lock:
+			if key not in self._sized:
+				self._sized[key] = sized
+				self._bytes += sized.nbytes
+			# drop the least recently used versions, but never the one just made
+			while self._bytes > self.max_bytes and len(self._sized) > 1:
+				_, old = self._sized.popitem(last=False)
+				self._bytes -= old.nbytes
+			return self._sized[key] if key in self._sized else sized
+
+# the textures of the process, shared by all the blends.
+TEXTURES = TextureCache()
+
+@staged('blend')
+def gradient_blend(im, textures=TEXTURES):
 	'''
 	Applies a blend of one image into a another, blends well when one is a mask
 	because I am using binary operations.
 
 	This will give a better visual effect when used with gradient images.
 	I guess waves could also look cool.. fires are dramatic lol..
+
+	textures: where the gradient images come from. they are read once per process and kept in
+	memory, so a blend does not touch the disk after the first one.
 	'''
 	img = cv2.cvtColor(im, cv2.COLOR_GRAY2BGR)
-	imgs = glob.glob('./gradients/*[.jpg, .png]')
-	if len(imgs) == 0:
+	paths = textures.paths()
+	if len(paths) == 0:
 		return "", img
-	random.shuffle(imgs)
-	
+
 	blends = {"AND": cv2.bitwise_and,
 			  "OR":cv2.bitwise_or,
 			  "XOR": cv2.bitwise_xor,
@@ -78,18 +226,13 @@ def gradient_blend(im):
 	the_chosen_one = random.choice(list(blends.keys()))
 	if the_chosen_one == "NOPE":
 		return "NO FILTER", img
-	
+
 	height, width = img.shape[:2]
-	# TODO:FEATURE: just resize the image to make it fit instead of looping no?
-	for f in imgs:
-		gradient = cv2.imread(f)
-		try:
-			# if the size of the gradient fits, use it, else, thank you, next.
-			gradient = gradient[0:height, 0:width]
-			blended  = blends[the_chosen_one](img,gradient)
-			return the_chosen_one + ':' + f , blended
-		except:
-			# go to the next image, this one didn't work
-			pass
-	# didn't find a size that fits
+	# every texture fits now: they are resized when too small.
+	# skip the ones that cannot be read.
+	for f in random.sample(paths, len(paths)):
+		gradient = textures.get(f, height, width)
+		if gradient is not None:
+			return the_chosen_one + ':' + f, blends[the_chosen_one](img, gradient)
+	# none of the textures could be read
 	return "", img
@@ -67,25 +67,55 @@
 
 # TODO:REFACTOR: use the factory design pattern in here for code reuse. also add this to the slides as improvements.
 # TODO: Compress the image before working with it.. but reconstruct it back. this will also help gradients images take less time..
-# TODO:REFACTOR: make an image class that will make it easy to pass attributes around. e.g. apend to label.
+# The image class: util.ImageContext. every tile function takes one in place of the image, so the variants
+# of the same image share its grayscale, equalized and block means planes.
+# TODO:REFACTOR: apend to label.
 # see https://www.researchgate.net/publication/328190353_IMAGE_COMPRESSION_USING_HAAR_WAVELET_TRANSFORM/link/5bbd99a192851c7fde376351/download
 
 import cv2
+import math
 import random
 import numpy as np
 from scipy.spatial import Delaunay, Voronoi, voronoi_plot_2d, delaunay_plot_2d
 
 # local import
 from mesh import lloyd_mesh, fib_mesh, random_pts
-from util import fill, map_range, rotate
+from util import fill, fill_nearest, map_range, block_means, SummedArea, label_map, outline_map, region_sums, paint_labels, ImageContext
 from stylise import gradient_blend
+from instrument import stage, staged
+import kernels
 
-def pentagons(im, points=[], contour=None, fib_step=None, lloyd_cells=None, isblank=False, queue=None):
+@staged('triangulation', kind='voronoi')
+def voronoi_regions(points):
+	'''
+	Returns the vertices of the finite regions of the voronoi diagram of the points.
+	'''
+	vor = Voronoi(points)
+	# get all the vertices ready and sent them to be filled or contoured
+	v = []
+	# get all the vertices of this region and
+	# check if the current region isn't reaching towards infinity
+	for region in vor.regions:
+		if not -1 in region and len(region) > 0:
+			v.append(vor.vertices[region])
+	return v
+
+@staged('triangulation', kind='delaunay')
+def delaunay_regions(points):
+	'''
+	Returns the vertices of the Delaunay triangles of the points.
+	'''
+	tri = Delaunay(points)
+	# get all the vertices of the triangles to sent them to be filled
+	return [points[x] for x in tri.simplices]
+
+def pentagons(im, points=[], contour=None, fib_step=None, lloyd_cells=None, isblank=False, queue=None, proxy=1, regions=None,
+			  engine='polygons'):
 	'''
 	Divides the image into hexagon/pentagon regions
 	Arguments:
 
-	im: the image to work with.
+	im: the image to work with, or its ImageContext.
 
 	points: a set of prefered points to use instead of provided option. Usually cached points
 	from previous itterations.
@@ -103,35 +133,43 @@ def pentagons(im, points=[], contour=None, fib_step=None, lloyd_cells=None, isbl
 
 	queue: when not None, the image is sent to the message queue instead of being returned.
 	This is particulal handy when running concurently.
+
+	proxy: the mesh is computed on the image downscaled proxy times, then scaled back up.
+	The regions are still filled at full resolution. see mesh.fib_mesh
+
+	regions: when a dict, it receives the palette and index image of the mosaic (see util.paint_labels),
+	e.g. to recolor it with stylise.map_regions.
+
+	engine: how the regions are drawn.
+	'polygons': the polygons of the scipy Voronoi diagram are filled (see util.fill).
+	'nearest': every pixel is labelled with its nearest point (see util.fill_nearest). faster,
+	and the regions reaching infinity are filled too, so the whole image is covered.
 	'''
+	assert engine in ('polygons', 'nearest'), 'unknown engine: {}'.format(engine)
+	context = ImageContext.of(im)
 	# copy the image, to prevent inplace operations
-	img = im.copy()
+	img = context.img.copy()
 	
 	if len(points) != 0:
 		# we got free points to work with
 		pass
 	elif fib_step:
 		# use fibonacci mesh
-		points = fib_mesh(img, fib_step)
+		points = fib_mesh(context, fib_step, proxy=proxy)
 	elif lloyd_cells:
 		# use lloyd mesh
-		points = lloyd_mesh(img, lloyd_cells)
+		points = lloyd_mesh(context, lloyd_cells, proxy=proxy)
 	else:
 		# use random points
-		points = random_pts(img)
+		points = random_pts(context)
 		
-	# create the voronoi dragrams
-	vor = Voronoi(points)
-	
-	# get all the vertices ready and sent them to be filled or contoured
-	v = []
-	# get all the vertices of this region and
-	# check if the current region isn't reaching towards infinity
-	for region in vor.regions:
-		if not -1 in region and len(region) > 0:
-			v.append(vor.vertices[region])
-	# fill all regions at once
-	fill(img, v, contour=contour, isblank=isblank)
+	if engine == 'nearest':
+		fill_nearest(img, points, contour=contour, isblank=isblank, regions=regions)
+	else:
+		# create the voronoi dragrams
+		v = voronoi_regions(points)
+		# fill all regions at once
+		fill(img, v, contour=contour, isblank=isblank, regions=regions)
 
 	# if running concurently send the items to the queue
 	if queue:
@@ -145,13 +183,13 @@ def pentagons(im, points=[], contour=None, fib_step=None, lloyd_cells=None, isbl
 		return img
 
 	
-def triangles(im, points=[], contour=None, fib_step = None, isblank=False, queue=None):
+def triangles(im, points=[], contour=None, fib_step = None, isblank=False, queue=None, proxy=1, regions=None):
 	'''
 	Divides the image into triangular regions.
 
 	Arguments:
 
-	im: the image to work with.
+	im: the image to work with, or its ImageContext.
 
 	points: a set of prefered points to use instead of provided option. Usually cached points
 	from previous itterations.
@@ -169,27 +207,32 @@ def triangles(im, points=[], contour=None, fib_step = None, isblank=False, queue
 
 	queue: when not None, the image is sent to the message queue instead of being returned.
 	This is particulal handy when running concurently.
+
+	proxy: the mesh is computed on the image downscaled proxy times, then scaled back up.
+	The regions are still filled at full resolution. see mesh.fib_mesh
+
+	regions: when a dict, it receives the palette and index image of the mosaic (see util.paint_labels),
+	e.g. to recolor it with stylise.map_regions.
 	'''
+	context = ImageContext.of(im)
 	# copy the image, to prevent inplace operations
-	img = im.copy()
+	img = context.img.copy()
 	
 	if len(points) != 0:
 		# we got free points to work with
 		pass
 	elif fib_step:
 		# use fibonacci mesh
-		points = fib_mesh(img, fib_step)
+		points = fib_mesh(context, fib_step, proxy=proxy)
 	else:
 		# use random points
-		points = random_pts(img)
+		points = random_pts(context)
 		
 	# create Delaunay triangles
-	tri = Delaunay(points)
-	# get all the vertices of the triangles to sent them to be filled
-	v = [points[x] for x in tri.simplices]
+	v = delaunay_regions(points)
 
 	# fill all the vertices.
-	fill(img, v, contour=contour, isblank=isblank)
+	fill(img, v, contour=contour, isblank=isblank, regions=regions)
 	# if running concurently send the items to the queue
 	if queue:
 		label = 'Triangles: '
@@ -201,12 +244,165 @@ def triangles(im, points=[], contour=None, fib_step = None, isblank=False, queue
 		return img
 	
 
-def squares(im, s=2, queue=None):
+class TriangleMosaic:
+	'''
+	A triangles mosaic that can be edited: points can be added or moved, and only the triangles
+	that changed are repainted, inside the boxes around them.
+	An edit costs the size of the change, not the size of the image.
+
+	The triangulation is incremental (scipy's Delaunay with incremental=True): added points are
+	inserted in it. moved points need a new triangulation, which is cheap next to painting.
+
+	e.g.
+	mosaic = TriangleMosaic(im, fib_mesh(im, 7))
+	mosaic.add([[120, 80]])
+	mosaic.move([3], [[400, 300]])
+	show(mosaic.image)
+
+	The points are in pixels. im: the image or its ImageContext. contour: see triangles.
+	'''
+	def __init__(self, im, points, contour=None):
+		self.im = ImageContext.of(im).img
+		self.contour = contour
+		self.tri = Delaunay(np.asarray(points, dtype=float), incremental=True)
+		# the average color of each triangle, by its key (see _keys)
+		self.average = {}
+		self.image = self.im.copy()
+		height, width = self.im.shape[:2]
+		self._paint(0, 0, width, height)
+
+	@staticmethod
+	def _keys(simplices):
+		# the sorted vertex indices of each triangle, packed in one integer (up to 2**21 points)
+		v = np.sort(simplices, axis=1).astype(np.int64)
+		return (v[:, 0] << 42) | (v[:, 1] << 21) | v[:, 2]
+
+	def add(self, points):
+		'''
+		Adds points to the mesh and repaints the triangles that changed.
+		Returns the (x0, y0, x1, y1) boxes that were repainted, none when nothing changed.
+		'''
+		simplices = self.tri.simplices.copy()
+		self.tri.add_points(np.asarray(points, dtype=float).reshape(-1, 2))
+		return self._update(simplices, self.tri.points)
+
+	def move(self, indices, points):
+		'''
+		Moves the points at indices to new positions and repaints the triangles that changed.
+		Returns the (x0, y0, x1, y1) boxes that were repainted, none when nothing changed.
+		'''
+		simplices = self.tri.simplices.copy()
+		old = self.tri.points.copy()
+		moved = old.copy()
+		moved[indices] = points
+		self.tri.close()
+		self.tri = Delaunay(moved, incremental=True)
+		return self._update(simplices, old, np.atleast_1d(indices))
+
+	def _update(self, simplices, old, moved=None):
+		'''
+		Repaints the triangles that are not in simplices (the triangles before the edit, on the old points)
+		anymore, and the new ones. moved: the indices of the points that moved.
+		'''
+		before, after = self._keys(simplices), self._keys(self.tri.simplices)
+		removed, added = ~np.isin(before, after), ~np.isin(after, before)
+		if moved is not None:
+			# the triangles of a moved point changed even when they keep the same vertices
+			removed |= np.isin(simplices, moved).any(axis=1)
+			added |= np.isin(self.tri.simplices, moved).any(axis=1)
+		for key in before[removed].tolist():
+			self.average.pop(key, None)
+		corners = np.concatenate([old[simplices[removed]], self.tri.points[self.tri.simplices[added]]])
+		boxes = self._boxes(corners)
+		for box in boxes:
+			self._paint(*box)
+		return boxes
+
+	def _boxes(self, corners):
+		'''
+		Returns the boxes around the (n, 3, 2) corners of the triangles: the boxes that overlap are merged,
+		e.g. the triangles around the old and the new place of a moved point are two boxes.
+		'''
+		height, width = self.im.shape[:2]
+		lo = np.clip(np.floor(corners.min(axis=1)).astype(int), 0, (width, height))
+		hi = np.clip(np.ceil(corners.max(axis=1)).astype(int) + 1, 0, (width, height))
+		boxes = [[x0, y0, x1, y1] for (x0, y0), (x1, y1) in zip(lo.tolist(), hi.tolist()) if x0 < x1 and y0 < y1]
+		merged = True
+		while merged:
+			merged, result = False, []
+			for box in boxes:
+				for other in result:
+					if box[0] < other[2] and other[0] < box[2] and box[1] < other[3] and other[1] < box[3]:
+						other[:] = min(box[0], other[0]), min(box[1], other[1]), max(box[2], other[2]), max(box[3], other[3])
+						merged = True
+						break
+				else:
+					result.append(box)
+			boxes = result
+		return [tuple(box) for box in boxes]
+
+	def _paint(self, x0, y0, x1, y1):
+		'''
+		Repaints the x0:x1, y0:y1 box of the mosaic with every triangle reaching it.
+		The triangles that are not fully in the box keep the color they were painted with.
+		'''
+		simplices = self.tri.simplices
+		corners = np.int32(self.tri.points[simplices])
+		lo, hi = corners.min(axis=1), corners.max(axis=1)
+		reach = np.flatnonzero((lo[:, 0] < x1) & (hi[:, 0] >= x0) & (lo[:, 1] < y1) & (hi[:, 1] >= y0))
+		keys = self._keys(simplices[reach]).tolist()
+		vertices = list(corners[reach] - np.int32([x0, y0]))
+		window = self.im[y0:y1, x0:x1].copy()
+		labels = label_map(window.shape, vertices)
+		sums, area = region_sums(window, labels, len(keys) + 1)
+		average = sums / np.maximum(area, 1)[:, None]
+		# the triangles already painted can be cut by the box: keep their average over all their pixels.
+		# the new ones are all in the box.
+		for i, key in enumerate(keys, 1):
+			if key in self.average:
+				average[i] = self.average[key]
+			else:
+				self.average[key] = average[i]
+		paint_labels(window, labels, len(keys) + 1, contour=self.contour,
+					 outlines=outline_map(window.shape, vertices), average=average)
+		self.image[y0:y1, x0:x1] = window
+
+@staged('fill', tile='squares')
+def _paint_squares(img, s, regions=None, color=None):
+	'''
+	Paints the s*s pixels tiles of the image with their average color, in place.
+	regions: see squares
+	color: the block_means of the image, when known already.
+	'''
+	height, width = img.shape[:2]
+	# get the average color of every tile at once
+	if color is None:
+		color = block_means(img, s)
+	# paint each tile with its color, the tiles on the right and bottom edges are cropped.
+	rows = np.repeat(np.uint8(color), s, axis=1)[:, :width]
+	n = (height // s) * s
+	img[:n].reshape(n // s, s, *img.shape[1:])[:] = rows[:n // s, None]
+	img[n:] = rows[-1]
+	# separate the tiles with a darker version of their color along their top and left sides.
+	edge = np.uint8(np.clip(np.rint(color - 30), 0, 255))
+	img[::s] = np.repeat(edge, s, axis=1)[:, :width]
+	img[:, ::s] = np.repeat(edge, s, axis=0)[:height]
+	if regions is not None:
+		# the tile of each pixel, and the edges use the second half of the palette
+		rows, cols = color.shape[:2]
+		y, x = np.arange(height, dtype=np.int32), np.arange(width, dtype=np.int32)
+		index = (y // s * cols)[:, None] + x // s
+		index[((y % s == 0)[:, None]) | (x % s == 0)] += rows * cols
+		regions['index'] = index
+		regions['palette'] = np.concatenate([np.uint8(color), edge]).reshape(2 * rows * cols, -1)
+	return img
+
+def squares(im, s=2, queue=None, regions=None):
 	'''
 	Subdivises the image into square tiles, of s% of the size of the image each.
 
 	Arguments:
-	im: the image to work with.
+	im: the image to work with, or its ImageContext.
 
 	s: the % of the image to be used as the side lengh of each square.
 	e.g. if the image is 100*100, and s = 2 each square tile will have the size:
@@ -216,23 +412,17 @@ def squares(im, s=2, queue=None):
 
 	queue: when not None, the image is sent to the message queue instead of being returned.
 	This is particulal handy when running concurently.
+
+	regions: when a dict, it receives the palette and index image of the mosaic (see util.paint_labels).
 	'''
 	s = s if s > 0 and s < 50 else 2
-	img = im.copy()
+	context = ImageContext.of(im)
+	img = context.img.copy()
 	#  size in percentage
 	height, width = img.shape[:2]
-	s = (s * max(width, height))// 100
+	s = max((s * max(width, height))// 100, 1)
 	
-	i, j = 0,0
-	while i < height:
-		j =0
-		while j < width:
-			y1, y2, x1, x2= i, i+s, j, j+s
-			color = img[y1:y2, x1: x2].mean(axis=0).mean(axis=0)
-			img[y1:y2, x1:x2] = color
-			img = cv2.rectangle(img,(x1,y1),(x2,y2),color-30,thickness=1)
-			j += s
-		i += s
+	_paint_squares(img, s, regions, context.block_means(s))
 	if queue:
 		label = 'Squares: Tile-Size: {}'.format(s)
 		queue.put((label, img))
@@ -242,54 +432,141 @@ def squares(im, s=2, queue=None):
 
 
 
+def _halftone(avg, s):
+	'''
+	Maps the average intensity of each cell to the radius and the fill color of its circle.
+	'''
+	# map the range of the radius using the avg value above.
+	# values closer to white will have small radius
+	radius = np.intp(map_range(avg, 0, 255, s//2, 2))
+	# The fill color will not be too black, for asthetic reasons. map it as well
+	# maximum black = 5, maximum white = 200
+	# (this changes crops the histogram from [0,255] to [5, 200])
+	fill_color = np.uint8(map_range(avg, 0, 255, 5, 200))
+	return radius, fill_color
+
+def _halftone_canvas(img, s, avg=None):
+	'''
+	Draws the circles of the grid of s*s cells of the grayscale image.
+	avg: the block_means of the image, when known already.
+	'''
+	height, width = img.shape[:2]
+	# the cells are the s*s blocks of the image, get the average color in each of them.
+	if avg is None:
+		avg = block_means(img, s)
+	radius, fill_color = _halftone(avg, s)
+	if s < 4:
+		# the smallest radius (2) is bigger than these cells: draw the circles one after the other
+		canvas = np.full((height, width), 255, dtype=np.uint8)
+		for (r, c), size in np.ndenumerate(radius):
+			cv2.circle(canvas, (c * s + s//2, r * s + s//2), int(size), int(fill_color[r, c]), -1)
+		return canvas
+	if kernels.backend() == 'numba':
+		return _spill(kernels.halftone(radius, fill_color, s, height, width), radius, fill_color, s)
+	# every cell has the same geometry: the squared distance of the pixels of a cell to its center
+	d = (np.arange(s) - s//2)**2
+	dist = d[:, None] + d[None, :]
+	# draw all the circles at once, on a canvas padded to whole cells:
+	# a pixel is inside the circle of its cell when it is closer to the center than the radius.
+	rows, cols = avg.shape
+	canvas = np.full((rows * s, cols * s), 255, dtype=np.uint8)
+	cells = canvas.reshape(rows, s, cols, s)
+	inside = dist[None, :, None, :] <= (radius**2)[:, None, :, None]
+	np.copyto(cells, fill_color[:, None, :, None], where=inside)
+	return _spill(np.ascontiguousarray(canvas[:height, :width]), radius, fill_color, s)
+
+def _spill(canvas, radius, fill_color, s):
+	'''
+	When s is even, a circle of the largest radius (s//2) goes one pixel past its cell, like cv2.circle
+	draws it: the middle pixel of the first column of the next cell, and of the first row of the cell below.
+	That pixel keeps its color unless the circle of its own cell, drawn after, covers it too.
+	'''
+	if s % 2:
+		return canvas
+	height, width = canvas.shape
+	largest = radius == s//2
+	# on the right
+	r, c = np.nonzero(largest[:, :-1] & ~largest[:, 1:])
+	y, x = r * s + s//2, (c + 1) * s
+	keep = (y < height) & (x < width)
+	canvas[y[keep], x[keep]] = fill_color[r[keep], c[keep]]
+	# below
+	r, c = np.nonzero(largest[:-1] & ~largest[1:])
+	y, x = (r + 1) * s, c * s + s//2
+	keep = (y < height) & (x < width)
+	canvas[y[keep], x[keep]] = fill_color[r[keep], c[keep]]
+	return canvas
+
+def _rotated_halftone(img, s, angle, table=None):
+	'''
+	Draws the circles of a grid of s*s cells rotated clockwise by angle around the centre of the image.
+	table: the SummedArea of the image, when known already.
+	'''
+	height, width = img.shape[:2]
+	theta = math.radians(angle)
+	cos, sin = np.float32(math.cos(theta)), np.float32(math.sin(theta))
+	ox, oy = np.float32(width / 2), np.float32(height / 2)
+	# u, v are the coordinates of each pixel in the rotated grid (the pixel rotated back)
+	x = np.arange(width, dtype=np.float32)[None, :]
+	y = np.arange(height, dtype=np.float32)[:, None]
+	u = ox + cos * (x - ox) + sin * (y - oy)
+	v = oy - sin * (x - ox) + cos * (y - oy)
+	# the cell of each pixel, numbered from the top left cell the image reaches
+	col, row = np.floor(u / s), np.floor(v / s)
+	col_0, row_0 = int(col.min()), int(row.min())
+	cols = np.arange(col_0, int(col.max()) + 1) * s + s//2
+	rows = np.arange(row_0, int(row.max()) + 1) * s + s//2
+	# the squared distance of each pixel to the center of its cell
+	u -= col * s + s//2
+	v -= row * s + s//2
+	dist = u * u + v * v
+	cell = (np.intp(row) - row_0) * len(cols) + (np.intp(col) - col_0)
+
+	# the center of each cell, back in the image
+	gu, gv = np.meshgrid(cols - ox, rows - oy)
+	cx = np.intp(np.rint(ox + cos * gu - sin * gv))
+	cy = np.intp(np.rint(oy + sin * gu + cos * gv))
+	# get the average color in the s*s region around each center.
+	# the regions of the cells on the edges are clipped to the image but never empty.
+	x1 = np.clip(cx - s//2, 1 - s, width - 1)
+	y1 = np.clip(cy - s//2, 1 - s, height - 1)
+	table = SummedArea(img) if table is None else table
+	radius, fill_color = _halftone(table.box_means(x1, y1, x1 + s, y1 + s), s)
+	# draw all the circles at once
+	inside = dist <= np.take(radius**2, cell)
+	return np.where(inside, np.take(fill_color, cell), np.uint8(255))
+
 def circles(im, s = .6, angle = 0, queue=None):
 	'''
 	Creates circular tiles of the image.
 	inspired by: https://www.gettyimages.ie/detail/illustration/monochrome-halftone-dots-wavy-pattern-royalty-free-illustration/626917876
 
-	BUG: The rotation isn't working as intended, on the real image. 
+	All the cells are computed at once, then all the circles are drawn in one go, from the distance
+	of each pixel to the center of its cell.
 	
 	Arguments:
 
-	im: the image to work with
+	im: the image to work with, or its ImageContext
 	s: the % of spacing between the tiles.
+	angle: the angle in degrees the grid of circles is rotated by, clockwise.
 	
 	'''
 	
 	s = s if s > 0 and s < 50 else 2
-	img = im.copy()
-	# as working only with the grascale value
-	img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-	# add the lightness to the image to increase contrast
-	img = cv2.equalizeHist(img)
+	context = ImageContext.of(im)
+	# as working only with the grascale value,
+	# with the lightness added to the image to increase contrast
+	img = context.equalized()
 	# set the maximum radius  size in % to keep the proportions
 	height, width = img.shape[:2]
 	
-	s = int(map_range(s, 0, 50, 0, max(width, height)))
-	
-	canvas = 255 * np.ones_like(img)
+	s = max(int(map_range(s, 0, 50, 0, max(width, height))), 1)
 	
-	for i in range(0, height, s):
-		for j in range(0, width, s):
-			# go s steps at a time and get the average color in each region.
-			y1, y2, x1, x2 = i, i+s, j,  j+s
-			# maybe rotate 45 degree here then calculat the mean at 45 degree?
-			avg = img[y1:y2, x1: x2].mean(axis=0).mean(axis=0)
-			# max radius is 20, map the range of the radius using the avg value above.
-			# values closer to white will have small radius
-			radius = int(map_range(avg, 0, 255, s//2, 2))
-			# The fill color will not be too black, for asthetic reasons. map it as well
-			# maximum black = 50, maximum white = 240 (
-			# this changes crops the histogram from [0,255] to [50, 240])
-			fill_color = int(map_range(avg, 0,255, 5, 200))
-			# the center of the circle
-			x, y = (x1 + x2)//2 , (y2+y1)//2
-			# if the mat has to be rotated
-			if angle % 360 != 0:
-				# now rotate the coordinates by this value
-				x, y = rotate(x-s, y, x, y, 135)
-			# draw the circles at this place
-			cv2.circle(canvas, (x,y), radius, fill_color, -1)
+	with stage('fill'):
+		if angle % 360 == 0:
+			canvas = _halftone_canvas(img, s, context.block_means(s, 'equalized'))
+		else:
+			canvas = _rotated_halftone(img, s, angle, context.table('equalized'))
 	canvas = cv2.addWeighted(canvas, .9, img, .1, 2)
 	blend_used, canvas = gradient_blend(canvas)
 	
@@ -298,7 +575,7 @@ def circles(im, s = .6, angle = 0, queue=None):
 		label = 'Circles: '
 		label += 'Steps: {} '.format(s)
 		label += 'Angle: {} '.format(angle)
-		label += 'Blend: {} '.format(blend_used) if blend_used is not '' else ''
+		label += 'Blend: {} '.format(blend_used) if blend_used != '' else ''
 		queue.put((label, canvas))
 	else:
 		# return return the image instead.
@@ -8,7 +8,20 @@
 
 import cv2
 import numpy as np
-import random, math
+import math
+import threading
+
+# local imports
+from instrument import stage
+import kernels
+
+def edge_pts(width, height):
+	'''
+	Returns the coordinates of the 4 edges of the screen, pushed off the screen by an offset.
+	see add_edges.
+	'''
+	o = 512 # the offset to bring infinite points off the screen
+	return np.array([[-o,-o], [width+o, -o], [-o, height+o], [width+o, height+o]])
 
 def add_edges(pts, width, height):
 	'''
@@ -24,8 +37,7 @@ def add_edges(pts, width, height):
 	reference: https://stackoverflow.com/questions/20515554/colorize-voronoi-diagram
 	
 	'''
-	o = 512 # the offset to bring infinite points off the screen
-	pts = np.append(pts, [[-o,-o], [width+o, -o], [-o, height+o], [width+o, height+o]], axis=0)
+	pts = np.append(pts, edge_pts(width, height), axis=0)
 	return pts
 
 def map_range(value, from_0, to_0, from_1, to_1):
@@ -58,11 +70,12 @@ def map_range(value, from_0, to_0, from_1, to_1):
 	'''
 	return from_1 + (to_1 - from_1) * ((value - from_0) / (to_0 - from_0))
 
-def randrange_pts_2d(x1, x2, y1, y2, count):
+def randrange_pts_2d(x1, x2, y1, y2, count, rng=None):
 	'''
 	Returns 'count' random pairs of indexes from a 2D array
 	x1-x2 the range of the width index
 	y1-y2 the range of the width index
+	rng: the numpy.random.Generator to draw from, a new unseeded one by default.
 	e.g.
 	>>> import numpy as np
 	>>> a = np.arange(28)
@@ -76,22 +89,169 @@ def randrange_pts_2d(x1, x2, y1, y2, count):
            [20, 21, 22, 23],
            [24, 25, 26, 27]])
 	>>> randrange_pts_2d(1,3,4,6,3)
-	array([[0, 0],
-          [2, 4],
-          [3, 5],
-          [2, 4]])
+	array([[2, 4],
+           [3, 5],
+           [2, 4]])
 	
-	As shown, apart from the [0,0] added in the initialisation, there are 3 random indexes
-	from the range provided. 
+	As shown, there are 3 random indexes from the range provided.
 	These indexes can now be used to retrieve the value from the aaray
 	'''
-	points = np.zeros((1,2), dtype=int)
-	for c in range(count):
-		i = random.randint(x1,x2)
-		j = random.randint(y1,y2)
-		points = np.append(points,[[i,j]], axis=0)
+	rng = np.random.default_rng() if rng is None else rng
+	points = np.empty((count, 2), dtype=int)
+	points[:, 0] = rng.integers(x1, x2, size=count, endpoint=True)
+	points[:, 1] = rng.integers(y1, y2, size=count, endpoint=True)
 	return points
 
+def block_sums(a, s, dtype=None):
+	'''
+	Sums the rows of the array a, s rows at a time.
+
+	The last block is smaller when len(a) is not a multiple of s.
+	'''
+	n = (len(a) // s) * s
+	sums = a[:n].reshape(n // s, s, *a.shape[1:]).sum(axis=1, dtype=dtype)
+	if n < len(a):
+		sums = np.append(sums, a[n:].sum(axis=0, keepdims=True, dtype=dtype), axis=0)
+	return sums
+
+def block_means(img, s):
+	'''
+	Returns the average color of every s*s block of the image, all at once.
+
+	The blocks on the right and bottom edges are smaller when the image size is not
+	a multiple of s; they are averaged over the pixels they actually have.
+	The result has one row per block row and one column per block column.
+	'''
+	height, width = img.shape[:2]
+	# sum the rows of each block row, this is the only pass over the whole image
+	sums = block_sums(img, s, np.uint32 if img.dtype == np.uint8 else np.float64)
+	# then the columns of each block column
+	sums = block_sums(sums.swapaxes(0, 1), s, np.float64).swapaxes(0, 1)
+	# the number of pixels in each block
+	area = np.outer(np.diff(np.append(np.arange(0, height, s), height)),
+					np.diff(np.append(np.arange(0, width, s), width)))
+	if sums.ndim > 2:
+		area = area[..., None]
+	return sums / area
+
+class SummedArea:
+	'''
+	The summed area table (integral image) of an image.
+
+	Once built, in one pass over the image, the sum of any box of the image costs 4 lookups,
+	whatever the size of the box. so the block means for any block size can be answered
+	without going through the image again.
+	more on that here: https://en.wikipedia.org/wiki/Summed-area_table
+	'''
+	def __init__(self, img):
+		self.shape = img.shape
+		self.table = cv2.integral(img, sdepth=cv2.CV_64F)
+
+	def box_means(self, x0, y0, x1, y1):
+		'''
+		Returns the average of the image inside each of the boxes [y0,y1[ * [x0,x1[ at once.
+
+		The boxes are given as arrays of coordinates, and are clipped to the image.
+		A box must not be empty once clipped.
+		'''
+		height, width = self.shape[:2]
+		x0, x1 = np.clip(x0, 0, width), np.clip(x1, 0, width)
+		y0, y1 = np.clip(y0, 0, height), np.clip(y1, 0, height)
+		t = self.table
+		sums = t[y1, x1] - t[y0, x1] - t[y1, x0] + t[y0, x0]
+		area = (x1 - x0) * (y1 - y0)
+		return sums / (area[..., None] if sums.ndim > area.ndim else area)
+
+	def block_means(self, s):
+		'''
+		Same as block_means(img, s), from the table.
+		'''
+		height, width = self.shape[:2]
+		ys = np.append(np.arange(0, height, s), height)
+		xs = np.append(np.arange(0, width, s), width)
+		return self.box_means(xs[None, :-1], ys[:-1, None], xs[None, 1:], ys[1:, None])
+
+class ImageContext:
+	'''
+	An image, and the planes derived from it: its grayscale and equalized versions, their summed area
+	tables and block means. Each one is computed the first time it is needed, then kept.
+
+	The tile and mesh functions all take one in place of the image: the variants of the same image
+	then share them. e.g. the grayscale plane is converted once for fib_mesh and circles,
+	and the 2% block means once for every fib_mesh and squares of that size.
+	e.g.
+	context = ImageContext(cv2.imread('./images/img_1.jpg'))
+	squares(context, s=5)
+	circles(context, s=2)
+	pentagons(context, fib_step=7)
+
+	The planes are shared, so they are read only. The image itself is never modified.
+	'''
+	def __init__(self, img):
+		self.img = img
+		self.shape = img.shape
+		self._planes = {}
+		# reentrant: a plane can be made from another one, e.g. equalized from gray
+		self._lock = threading.RLock()
+
+	@staticmethod
+	def of(im):
+		'''
+		Returns im when it is an ImageContext already, else a new context of the image im.
+		'''
+		return im if isinstance(im, ImageContext) else ImageContext(im)
+
+	def _get(self, key, compute):
+		with self._lock:
+			if key not in self._planes:
+				value = compute()
+				if isinstance(value, np.ndarray):
+					value.flags.writeable = False
+				self._planes[key] = value
+			return self._planes[key]
+
+	def plane(self, name='image'):
+		'''
+		Returns the plane called name: 'image', 'gray' or 'equalized'.
+		'''
+		if name == 'image':
+			return self.img
+		if name == 'gray':
+			return self.gray()
+		if name == 'equalized':
+			return self.equalized()
+		raise ValueError('unknown plane: {} (expected image, gray or equalized)'.format(name))
+
+	def gray(self):
+		'''
+		Returns the grayscale image. (the image itself when it is grayscale already)
+		'''
+		if len(self.shape) == 2:
+			return self.img
+		return self._get(('gray',), lambda: cv2.cvtColor(self.img, cv2.COLOR_BGR2GRAY))
+
+	def equalized(self):
+		'''
+		Returns the histogram equalized grayscale image, see circles.
+		'''
+		return self._get(('equalized',), lambda: cv2.equalizeHist(self.gray()))
+
+	def table(self, plane='gray'):
+		'''
+		Returns the SummedArea of the plane.
+		'''
+		return self._get(('table', plane), lambda: SummedArea(self.plane(plane)))
+
+	def block_means(self, s, plane='image'):
+		'''
+		Returns the block_means of the plane, s*s pixels blocks.
+		They come from the summed area table of the plane when it was made already.
+		'''
+		def compute():
+			table = self._planes.get(('table', plane))
+			return table.block_means(s) if table is not None else block_means(self.plane(plane), s)
+		return self._get(('block_means', plane, s), compute)
+
 def normalise(vertices, img):
 	'''
 	Normalise vertices from [0,1] to [0,width), [0,height) if the maximum value of the vertices
@@ -107,36 +267,211 @@ def normalise(vertices, img):
 		# get rid of the floating point from previous range [0,1[
 	return np.int32(v)
 
-def fill(img, vertices, contour=None, isblank=False):
+def label_map(shape, vertices):
 	'''
-	Fills the region inide the images with polygons whose coordinates are in the vertices array.
+	Rasterises all the polygons in the vertices array once into an integer label image.
+
+	The pixels covered by polygon vertices[i] are labelled i+1, 0 means no polygon covers it.
+	When polygons overlap, the later one wins, exactly like successive cv2.fillPoly calls would.
 	'''
-	for v in vertices:
-		if len(v) < 1: # empty vertices are of no use, maybe 2, too, but might be a contour line. 
+	labels = np.zeros(shape[:2], dtype=np.int32)
+	for i, v in enumerate(vertices, 1):
+		if len(v) < 1: # empty vertices are of no use
 			continue
-		if isblank: # speed up. just the contour overlay. no fill needed.
-			contour = 0 if contour is None else contour
-			img = cv2.polylines(img, [v], True, contour, 1)
+		cv2.fillPoly(labels, [v], i)
+	return labels
+
+def region_sums(img, labels, count):
+	'''
+	Returns the sum of the colors of every region of the label image and its number of pixels, in one pass.
+
+	count: the number of labels, including the 0 label.
+	'''
+	if kernels.backend() == 'numba':
+		return kernels.region_sums(img, labels, count)
+	flat = labels.ravel()
+	pixels = img.reshape(flat.size, -1)
+	area = np.bincount(flat, minlength=count)
+	sums = np.empty((count, pixels.shape[1]))
+	for c in range(pixels.shape[1]):
+		sums[:, c] = np.bincount(flat, weights=pixels[:, c], minlength=count)
+	return sums, area
+
+def region_means(img, labels, count):
+	'''
+	Returns the average color of every region of the label image, in one pass.
+
+	count: the number of labels, including the 0 label.
+
+	The result is a (count, channels) float array, regions without any pixel average to 0.
+	'''
+	sums, area = region_sums(img, labels, count)
+	return sums / np.maximum(area, 1)[:, None]
+
+def outline_map(shape, vertices):
+	'''
+	Rasterises the outline of all the polygons in the vertices array into an integer label image.
+
+	The pixels on the outline of vertices[i] are labelled i+1, 0 means no outline goes through it.
+	This is the counterpart of label_map for the contours between the polygons.
+	'''
+	outlines = np.zeros(shape[:2], dtype=np.int32)
+	for i, v in enumerate(vertices, 1):
+		if len(v) < 1:
 			continue
-		# normalise the vertices if they are not in the range of the images's coordinates
-		v = normalise(v, img)
-		# the mask on the image that will isolate the current triangle
-		mask = np.zeros(img.shape[:2], dtype=np.uint8)
-		# covering the image, but the current
-		# this is needed to calculate the average color of this portion.
-		mask = cv2.fillPoly(mask, [v], 255)
-		# get the average color of the portion covered by the mask
-		average = np.array(cv2.mean(img, mask))
-		# now fill that portion with the average color computed above.
-		cv2.fillPoly(img, [v], average)
-		# separate the polygons with a darker version of this average color
-		# or the contour color if specified
+		cv2.polylines(outlines, [v], True, i, 1)
+	return outlines
+
+def label_edges(labels):
+	'''
+	Returns an outline image (see outline_map) computed from the label changes of a label image.
+
+	The border is one pixel wide: only the pixel on the left/top side of a label change is marked,
+	with the label of the region it belongs to.
+	'''
+	edges = np.zeros(labels.shape, dtype=bool)
+	edges[:, :-1] = labels[:, :-1] != labels[:, 1:]
+	edges[:-1, :] |= labels[:-1, :] != labels[1:, :]
+	return np.where(edges, labels, 0)
+
+def paint_labels(img, labels, count, contour=None, isblank=False, outlines=None, average=None, regions=None):
+	'''
+	Fills every region of the label image with its average color, and draws the borders between regions.
+
+	Pixels labelled 0 are left untouched.
+	The border is a darker version of the region's average color, or the contour color if specified.
+
+	outlines: the outline image of the regions (see outline_map), when None it is derived from
+	the label changes (see label_edges). An outline pixel is drawn when its polygon was drawn after
+	the one filling that pixel, as if each polygon was filled then contoured one after the other.
+
+	isblank: when True, only the borders are drawn, with the contour color, else 0 (black)
+
+	average: the average color of each label, when already known. computed from the image by default.
+
+	regions: when a dict, it receives the mosaic as a palette and an index image (see palette_map):
+	the painted image is palette[index]. not filled when isblank.
+	'''
+	if outlines is None:
+		with stage('contour'):
+			outlines = label_edges(labels)
+	if isblank: # speed up. just the contour overlay. no fill needed.
+		with stage('contour'):
+			img[outlines > 0] = 0 if contour is None else contour
+		return img
+	with stage('fill'):
+		# get the average color of each region
+		if average is None:
+			average = region_means(img, labels, count)
+		palette = np.uint8(np.clip(np.rint(average), 0, 255))
 		if contour is None:
-			img = cv2.polylines(img, [v], True, average-16, 1)
+			edge_palette = np.uint8(np.clip(np.rint(average - 16), 0, 255))
+		else:
+			edge_palette = np.empty_like(palette)
+			edge_palette[:] = contour
+		# the numba kernels go through the pixels without a mask. the regions need the masks anyway.
+		compiled = kernels.backend() == 'numba' and img.flags.c_contiguous
+		covered = None if compiled and regions is None else labels > 0
+		# now fill each region with the average color computed above.
+		if compiled:
+			kernels.fill(img, labels, palette)
+		elif covered.all():
+			# every pixel is in a region (e.g. see nearest_labels): gather them without a mask
+			np.take(palette, labels, axis=0, out=img.reshape(labels.shape + palette.shape[1:]))
 		else:
-			img = cv2.polylines(img, [v], True, contour, 1)	
+			img[covered] = palette[labels[covered]]
+	with stage('contour'):
+		# separate the polygons with a darker version of this average color
+		# or the contour color if specified
+		if covered is None:
+			kernels.contour(img, labels, outlines, edge_palette)
+			return img
+		edges = (outlines > 0) & (outlines >= labels)
+		if regions is not None:
+			regions.update(palette_map(img, labels, count, covered, edges, outlines, palette, edge_palette))
+		img[edges] = edge_palette[outlines[edges]]
 	return img
 
+def palette_map(img, labels, count, covered, edges, outlines, palette, edge_palette):
+	'''
+	Describes a mosaic painted by paint_labels as a palette of colors and an index image,
+	before the borders are drawn on the image.
+
+	The palette is the fill color of each label, then the border color of each label,
+	then the pixels no polygon covers, which keep their own color.
+
+	Returns a dict of the 'index' (int32 image) and the 'palette' (uint8 (n, channels) array).
+	'''
+	index = labels.copy()
+	index[edges] = count + outlines[edges]
+	untouched = ~(covered | edges)
+	pixels = img[untouched].reshape(-1, palette.shape[1])
+	index[untouched] = 2 * count + np.arange(len(pixels), dtype=np.int32)
+	return {'index': index, 'palette': np.concatenate([palette, edge_palette, pixels])}
+
+def fill(img, vertices, contour=None, isblank=False, regions=None):
+	'''
+	Fills the region inide the images with polygons whose coordinates are in the vertices array.
+
+	All the polygons and their outlines are rasterised once into label images (see label_map),
+	then every region's average color is computed in one go (see paint_labels).
+	The average of a polygon is taken over the original pixels it keeps in the label image:
+	the borders it shares go to the polygons drawn after it.
+
+	This is not the same as filling the polygons one after the other with their average over their
+	whole mask, as this used to: the borders of a polygon were then already painted by its neighbours
+	(their fill and darker outline), and were part of its average. The colors differ, the more so
+	the smaller the polygons: e.g. on img_1.jpg (687x536) with 800 random points, 94% of the pixels
+	of the triangles differ, 49% by more than 2 levels, up to 79. 91% of the pentagons, up to 16 levels.
+	The outlines and the pixels each polygon covers are the same.
+
+	regions: when a dict, it receives the palette and index image of the result (see paint_labels).
+	'''
+	# normalise the vertices if they are not in the range of the images's coordinates
+	vertices = [normalise(v, img) for v in vertices if len(v) > 0]
+	with stage('contour'):
+		outlines = outline_map(img.shape, vertices)
+	if isblank:
+		return paint_labels(img, None, 0, contour=contour, isblank=True, outlines=outlines)
+	with stage('fill'):
+		labels = label_map(img.shape, vertices)
+	return paint_labels(img, labels, len(vertices) + 1, contour=contour, outlines=outlines, regions=regions)
+
+def nearest_labels(shape, sites):
+	'''
+	Labels every pixel with its nearest site: the Voronoi regions of the sites, as a label image.
+
+	The sites off the image are ignored, the ones in the same pixel are merged.
+	Uses the labelled distance transform of opencv: one pass over the pixels, no polygon.
+	(the regions are the exact Voronoi regions up to the pixels at a pixel from a border)
+
+	Returns the label image, where every pixel is labelled 1 or more, and the number of labels
+	including the 0 label, like label_map.
+	'''
+	height, width = shape[:2]
+	sites = np.floor(np.asarray(sites, dtype=float)).astype(np.int64)
+	inside = (sites[:, 0] >= 0) & (sites[:, 0] < width) & (sites[:, 1] >= 0) & (sites[:, 1] < height)
+	seeds = np.ones((height, width), dtype=np.uint8)
+	seeds[sites[inside, 1], sites[inside, 0]] = 0
+	if seeds.all():
+		# no site on the image: one region
+		return np.ones((height, width), dtype=np.int32), 2
+	# every seed pixel gets its own label, in row order
+	_, labels = cv2.distanceTransformWithLabels(seeds, cv2.DIST_L2, cv2.DIST_MASK_PRECISE,
+												labelType=cv2.DIST_LABEL_PIXEL)
+	return labels, int(np.count_nonzero(seeds == 0)) + 1
+
+def fill_nearest(img, sites, contour=None, isblank=False, regions=None):
+	'''
+	Fills the Voronoi regions of the sites, like fill does with the polygons of a Voronoi diagram,
+	but from the nearest site of every pixel (see nearest_labels).
+	The whole image is covered, the borders come from the label changes.
+	'''
+	with stage('fill', engine='nearest'):
+		labels, count = nearest_labels(img.shape, sites)
+	if isblank:
+		return paint_labels(img, None, 0, contour=contour, isblank=True, outlines=label_edges(labels))
+	return paint_labels(img, labels, count, contour=contour, regions=regions)
 
 def rotate(xo,yo,x,y,angle):
 	"""
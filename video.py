@@ -0,0 +1,205 @@
+# Tatiana Zihindula
+# C16339923
+# "Group" Project
+# 23/11/2019
+
+# Mosaics of videos, frame after frame.
+#
+# The mesh is made once, from the first frame, and so are the regions: the label image of the
+# triangles/pentagons and their borders. Every frame then only needs the average color of each region,
+# a few thousand colors, and one lookup to paint them all.
+# The colors of a region only change when its average moved by more than a threshold:
+# the mosaic does not flicker with the noise of the video, and a still frame costs no painting.
+#
+# The average colors are taken on the frame downscaled 'sample' times: a region has hundreds of pixels,
+# its average barely changes.
+#
+# lloyd meshes can be relaxed a little every few frames (relax), from the previous mesh.
+# the regions are made again then.
+#
+# run: python video.py input.mp4 output.mp4 --tile pentagons --fib-step 7
+
+import time, argparse
+import cv2
+import numpy as np
+
+# local imports
+from mesh import fib_mesh, lloyd_mesh, random_pts
+from tiles import delaunay_regions
+from util import label_map, outline_map, nearest_labels, label_edges
+
+class VideoMosaic:
+	'''
+	Paints the frames of a video as triangles or pentagons, with the regions of the first frame.
+
+	tile: 'triangles' or 'pentagons'
+
+	fib_step, lloyd_cells, points: the mesh, see tiles.pentagons. random points by default.
+
+	contour: the color of the borders, darker than their region by default.
+
+	threshold: the change of the average color of a region, in intensity levels, below which
+	the region keeps its color.
+
+	sample: the average colors are computed on the frame downscaled sample times.
+
+	relax: when not 0, a lloyd mesh is relaxed by one itteration every 'relax' frames.
+
+	e.g.
+	mosaic = VideoMosaic(first_frame, 'pentagons', fib_step=7)
+	for frame in frames:
+		out = mosaic.render(frame)
+	'''
+	def __init__(self, frame, tile='pentagons', fib_step=None, lloyd_cells=None, points=None, contour=None,
+				 threshold=2., sample=2, relax=0):
+		assert tile in ('triangles', 'pentagons'), 'unknown tile type: {}'.format(tile)
+		self.shape = frame.shape
+		self.tile = tile
+		self.lloyd_cells = lloyd_cells if tile == 'pentagons' else None
+		self.contour = contour
+		self.threshold = threshold
+		self.sample = max(int(sample), 1)
+		self.relax = relax if self.lloyd_cells else 0
+		self.frames = 0
+
+		if points is not None and len(points) != 0:
+			pass
+		elif fib_step:
+			points = fib_mesh(frame, fib_step)
+		elif self.lloyd_cells:
+			points = lloyd_mesh(frame, self.lloyd_cells)
+		else:
+			points = random_pts(frame)
+		self._build(np.asarray(points, dtype=float))
+
+	def _build(self, points):
+		'''
+		Makes the regions of the points: the index of every pixel in the palette, see util.palette_map.
+		The palette is the color of each region, then the color of its border.
+		'''
+		self.points = points
+		if self.tile == 'pentagons':
+			# every pixel is labelled with its nearest point: no region is left out.
+			labels, count = nearest_labels(self.shape, points)
+			outlines = label_edges(labels)
+		else:
+			vertices = [np.int32(v) for v in delaunay_regions(points)]
+			labels = label_map(self.shape, vertices)
+			outlines = outline_map(self.shape, vertices)
+			count = len(vertices) + 1
+		# the pixels no region covers (label 0) are one more region
+		edges = (outlines > 0) & (outlines >= labels)
+		self.count = count
+		self.index = labels.copy()
+		self.index[edges] = count + outlines[edges]
+		# the label of the pixels of the downscaled frames: the center of each block
+		s = self.sample
+		height, width = self.shape[:2]
+		self.small = labels[s // 2::s, s // 2::s][:height // s, :width // s].ravel()
+		self.area = np.bincount(self.small, minlength=count)
+		self.average = None
+		self.out = None
+		# the palette, as BGRA packed in 32 bits: painting is one lookup of 32 bits integers.
+		self.palette = np.zeros((2 * count, 4), dtype=np.uint8)
+		self._packed = self.palette.view(np.uint32)[:, 0]
+		self._painted = np.empty(self.shape[:2], dtype=np.uint32)
+
+	def means(self, frame):
+		'''
+		Returns the average color of every region of the frame.
+		'''
+		s = self.sample
+		height, width = self.shape[:2]
+		small = frame if s == 1 else cv2.resize(frame, (width // s, height // s), interpolation=cv2.INTER_AREA)
+		pixels = small.reshape(-1, 3)
+		sums = np.column_stack([np.bincount(self.small, weights=pixels[:, c], minlength=self.count) for c in range(3)])
+		return sums / np.maximum(self.area, 1)[:, None]
+
+	def render(self, frame):
+		'''
+		Returns the mosaic of the next frame.
+		The returned image is reused for the next frames: copy it to keep it.
+		'''
+		self.frames += 1
+		if self.relax and self.frames % self.relax == 0:
+			# move the sites towards the centroid of their region, from where they are.
+			self._build(lloyd_mesh(frame, self.lloyd_cells, itter=1, init=self.points))
+
+		average = self.means(frame)
+		if self.average is None:
+			changed = np.ones(self.count, dtype=bool)
+		else:
+			changed = np.abs(average - self.average).max(axis=1) > self.threshold
+		if self.out is not None and not changed.any():
+			# nothing moved: the previous mosaic is this one too.
+			return self.out
+		if self.average is None:
+			self.average = average
+		else:
+			self.average[changed] = average[changed]
+
+		# the colors of the changed regions and of their borders
+		self.palette[:self.count][changed, :3] = np.uint8(np.clip(np.rint(average[changed]), 0, 255))
+		if self.contour is None:
+			self.palette[self.count:][changed, :3] = np.uint8(np.clip(np.rint(average[changed] - 16), 0, 255))
+		else:
+			self.palette[self.count:, :3] = self.contour
+		np.take(self._packed, self.index, out=self._painted)
+		self.out = cv2.cvtColor(self._painted.view(np.uint8).reshape(self.shape[:2] + (4,)), cv2.COLOR_BGRA2BGR,
+								dst=self.out)
+		return self.out
+
+def render_video(src, dst, tile='pentagons', fourcc='mp4v', log_every=100, **kwargs):
+	'''
+	Reads the video at src, and writes its mosaic to dst. kwargs: see VideoMosaic.
+	Returns the number of frames written and the frames per second.
+	'''
+	capture = cv2.VideoCapture(src)
+	if not capture.isOpened():
+		raise IOError('cannot read video: {}'.format(src))
+	fps = capture.get(cv2.CAP_PROP_FPS) or 25
+	writer = None
+	mosaic = None
+	frames = 0
+	start = time.perf_counter()
+	try:
+		while True:
+			ok, frame = capture.read()
+			if not ok:
+				break
+			if mosaic is None:
+				mosaic = VideoMosaic(frame, tile, **kwargs)
+				height, width = frame.shape[:2]
+				writer = cv2.VideoWriter(dst, cv2.VideoWriter_fourcc(*fourcc), fps, (width, height))
+				if not writer.isOpened():
+					raise IOError('cannot write video: {}'.format(dst))
+			writer.write(mosaic.render(frame))
+			frames += 1
+			if log_every and frames % log_every == 0:
+				print('--{} frames, {:.1f} frames/s--'.format(frames, frames / (time.perf_counter() - start)))
+	finally:
+		capture.release()
+		if writer is not None:
+			writer.release()
+	return frames, frames / max(time.perf_counter() - start, 1e-9)
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Renders the mosaic of a video.')
+	parser.add_argument('src', help='the video to read')
+	parser.add_argument('dst', help='the video to write, e.g. out.mp4')
+	parser.add_argument('--tile', default='pentagons', choices=['pentagons', 'triangles'])
+	parser.add_argument('--fib-step', type=int, default=None, help='use a fibonacci mesh, see tiles.pentagons')
+	parser.add_argument('--lloyd-cells', type=int, default=None, help='use a lloyd mesh (pentagons only)')
+	parser.add_argument('--threshold', type=float, default=2., help='the color change a region ignores. default: 2')
+	parser.add_argument('--sample', type=int, default=2, help='compute the colors on frames this many times smaller. default: 2')
+	parser.add_argument('--relax', type=int, default=0, help='relax a lloyd mesh every this many frames. default: never')
+	parser.add_argument('--fourcc', default='mp4v', help='the codec of the output. default: mp4v')
+	args = parser.parse_args(argv)
+
+	frames, fps = render_video(args.src, args.dst, args.tile, args.fourcc, fib_step=args.fib_step,
+							   lloyd_cells=args.lloyd_cells, threshold=args.threshold, sample=args.sample,
+							   relax=args.relax)
+	print('{} frames at {:.1f} frames/s'.format(frames, fps))
+
+if __name__ == '__main__':
+	main()